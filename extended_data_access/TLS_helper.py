@@ -1,16 +1,39 @@
+import copy
+import struct
 import time
 from wolfssl import SSLContext, PROTOCOL_TLSv1_3, CERT_REQUIRED
 import socket
+from tools import JSON_CODEC, BSON_CODEC, encode_message, decode_message
+from tracing import tracer
+
+# Every frame is a 1 byte frame type followed by the 4 bytes big endian payload length.
+FRAME_HEADER = struct.Struct("!BI")
+FRAME_MESSAGE = 0
+FRAME_CHUNK = 1
+FRAME_END = 2
+FRAME_TYPE_MASK = 0x7F
+# Flag set on the frame type when the message is BSON rather than JSON
+FRAME_BSON = 0x80
+STREAM_CHUNK_SIZE = 256 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Largest streamed message receive_payload reassembles, receive_stream consumers are not bounded
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
 
 class TLSHelper:
-    def __init__(self, ca_cert_file, self_cert_file=None, key_file=None, is_server=False):
+    def __init__(self, ca_cert_file, self_cert_file=None, key_file=None, is_server=False, chunk_size=STREAM_CHUNK_SIZE, max_frame_size=MAX_FRAME_SIZE, codec=JSON_CODEC, max_message_size=MAX_MESSAGE_SIZE):
         self.context = SSLContext(PROTOCOL_TLSv1_3, server_side=is_server)
         self.context.verify_mode = CERT_REQUIRED
-        if is_server:
+        # Clients that have a certificate present it, the asyncio servers of AsyncTLSHelper require one
+        if is_server or self_cert_file:
             self.context.load_cert_chain(self_cert_file, key_file)
         self.context.load_verify_locations(ca_cert_file)
         self.is_server = is_server
         self.socket_ = None
+        self.server_socket = None
+        self.chunk_size = chunk_size
+        self.max_frame_size = max_frame_size
+        self.max_message_size = max_message_size
+        self.codec = codec
 
     def connect(self, host, port):
         max_tries = 30
@@ -36,20 +59,162 @@ class TLSHelper:
                 time.sleep(delay)
         raise ConnectionError("Failed to establish connection after multiple attempts")
 
-    def send(self, message):
+    # =============================================================================
+    # Multi-client server mode
+    # =============================================================================
+
+    def listen(self, host, port, backlog=128):
+        """Binds a listening socket so that any number of clients can be accepted."""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(backlog)
+
+    def accept(self):
+        """Waits for the next client and returns its raw socket, the TLS handshake is left to wrap_accepted."""
+        if not self.server_socket:
+            raise ConnectionError("Helper is not listening")
+        conn, addr = self.server_socket.accept()
+        return conn
+
+    def wrap_accepted(self, conn):
+        """Performs the TLS handshake on an accepted socket and returns a helper dedicated to it."""
+        connection = copy.copy(self)
+        connection.server_socket = None
+        connection.socket_ = self.context.wrap_socket(conn, server_side=True)
+        return connection
+
+    # =============================================================================
+    # Sending
+    # =============================================================================
+
+    def send(self, message, flags=0):
         if not self.socket_:
             raise ConnectionError("No active connection to send data")
         if isinstance(message, str):
             message = message.encode('utf-8')
-        self.socket_.sendall(message)
+        if len(message) > self.chunk_size:
+            view = memoryview(message)
+            self.send_stream((view[offset:offset + self.chunk_size] for offset in range(0, len(view), self.chunk_size)), flags)
+        else:
+            self.send_frame(FRAME_MESSAGE | flags, message)
 
-    def receive(self, buffer_size=4096):
+    def send_message(self, message):
+        """Sends a dict with the codec negotiated on this connection, with the trace id of the query being served."""
+        if tracer.enabled:
+            trace_id = tracer.get_trace_id()
+            if trace_id is not None:
+                message = dict(message, trace_id=trace_id)
+        self.send(encode_message(message, self.codec), FRAME_BSON if self.codec == BSON_CODEC else 0)
+
+    def send_stream(self, chunks, flags=0):
+        """Sends an iterable of byte chunks as one streamed message, closed by an end frame."""
+        if not self.socket_:
+            raise ConnectionError("No active connection to send data")
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if len(chunk) > 0:
+                self.send_frame(FRAME_CHUNK | flags, chunk)
+        self.send_frame(FRAME_END | flags, b"")
+
+    def send_frame(self, frame_type, payload):
+        if len(payload) > self.max_frame_size:
+            raise ValueError(f"Frame of {len(payload)} bytes exceeds the {self.max_frame_size} bytes limit")
+        header = FRAME_HEADER.pack(frame_type, len(payload))
+        if len(payload) <= self.chunk_size // 16:
+            # Small frames go out in a single TLS record
+            self.socket_.sendall(header + bytes(payload))
+        else:
+            self.socket_.sendall(header)
+            self.socket_.sendall(payload)
+
+    # =============================================================================
+    # Receiving
+    # =============================================================================
+
+    def receive(self, buffer_size=65536):
+        flags, payload = self.receive_payload(buffer_size)
+        return payload.decode('utf-8')
+
+    def receive_message(self, buffer_size=65536):
+        """
+        Receives a dict, a server adopts the codec chosen by its client for its answers and the trace id
+        of the request for its spans.
+        """
+        flags, payload = self.receive_payload(buffer_size)
+        codec = BSON_CODEC if flags & FRAME_BSON else JSON_CODEC
+        if self.is_server:
+            self.codec = codec
+        message = decode_message(payload, codec)
+        trace_id = message.pop("trace_id", None)
+        if self.is_server and tracer.enabled:
+            tracer.set_trace_id(trace_id)
+        return message
+
+    def receive_payload(self, buffer_size=65536):
+        """
+        Returns the flags and the payload of the next message, streamed messages are reassembled. A stream
+        longer than max_message_size raises ConnectionError, the rest of it is left unread and the
+        connection can not be used anymore.
+        """
+        if not self.socket_:
+            raise ConnectionError("No active connection to receive data")
+        frame_type, payload = self.receive_frame(buffer_size)
+        flags = frame_type & ~FRAME_TYPE_MASK
+        frame_type &= FRAME_TYPE_MASK
+        if frame_type == FRAME_CHUNK:
+            message = bytearray(payload)
+            for chunk in self.receive_stream(buffer_size):
+                if len(message) + len(chunk) > self.max_message_size:
+                    raise ConnectionError(f"Streamed message exceeds the {self.max_message_size} bytes limit")
+                message += chunk
+            payload = message
+        elif frame_type != FRAME_MESSAGE:
+            raise ConnectionError(f"Unexpected frame type {frame_type}")
+        return flags, payload
+
+    def receive_stream(self, buffer_size=65536):
+        """Yields the chunks of a streamed message until its end frame is received."""
         if not self.socket_:
             raise ConnectionError("No active connection to receive data")
-        data = self.socket_.recv(buffer_size)
-        return data.decode('utf-8')
+        while True:
+            frame_type, payload = self.receive_frame(buffer_size)
+            frame_type &= FRAME_TYPE_MASK
+            if frame_type == FRAME_END:
+                return
+            if frame_type != FRAME_CHUNK:
+                raise ConnectionError(f"Unexpected frame type {frame_type} in stream")
+            yield payload
+
+    def receive_frame(self, buffer_size=65536):
+        header = self.receive_exactly(FRAME_HEADER.size, buffer_size)
+        frame_type, length = FRAME_HEADER.unpack(header)
+        if length > self.max_frame_size:
+            raise ConnectionError(f"Announced frame of {length} bytes exceeds the {self.max_frame_size} bytes limit")
+        return frame_type, self.receive_exactly(length, buffer_size)
+
+    def receive_exactly(self, size, buffer_size=65536):
+        """Reads exactly size bytes into a preallocated buffer."""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = self.socket_.recv_into(view[received:], min(size - received, buffer_size))
+            if count == 0:
+                raise ConnectionError("Connection closed by peer")
+            received += count
+        return buffer
 
     def close(self):
+        if self.server_socket:
+            try:
+                # Wakes up a thread blocked in accept()
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+            self.server_socket = None
         if self.socket_:
             self.socket_.shutdown(socket.SHUT_RDWR)
             self.socket_.close()
@@ -0,0 +1,145 @@
+import datetime
+import threading
+from change_feed import ChangeFeed
+
+class AccessControlIndex:
+    """
+    Materialized view of the accessControls collection keyed by (access control id, user id). Every entry
+    holds the permissions and expirations granted to the user, so an authorization check is a dict lookup
+    instead of a $lookup. The view follows the change feed of the collection document by document and is
+    only up to date while a change stream is followed, see live. Polling would leave revoked grants in
+    the view for as long as the poll interval, so without change streams the view is not consulted and
+    the listeners are told every poll_interval seconds to drop what they derived from access controls.
+    """
+    def __init__(self, collection, poll_interval=5):
+        self.collection = collection
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.users = {}
+        # Called with the id of every changed access control, or None when the whole index was reloaded
+        self.listeners = []
+        self.feed = ChangeFeed(collection, self.apply_change, self.refresh, poll_interval, max_staleness=poll_interval)
+        self.reload()
+        self.feed.start()
+
+    # =============================================================================
+    # Authorization
+    # =============================================================================
+
+    @property
+    def live(self):
+        """Whether check() can be trusted, authorizations must be read from the collection otherwise."""
+        return self.feed.live
+
+    def check(self, access_control_ids, user_id, attestation):
+        """
+        Returns (allowed, enclave) for the user on any of the access controls. allowed is granted by an
+        unexpired read permission, or an unexpired enclave permission when the user is attested.
+        enclave tells whether an unexpired enclave permission exists at all.
+        """
+        if not isinstance(access_control_ids, list):
+            access_control_ids = [access_control_ids]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        allowed = False
+        enclave = False
+        for access_control_id in access_control_ids:
+            for permissions, expiration in self.entries.get((access_control_id, user_id), ()):
+                if not self.is_unexpired(expiration, now):
+                    continue
+                if "enclave" in permissions:
+                    enclave = True
+                    allowed = allowed or attestation is True
+                if "read" in permissions:
+                    allowed = True
+        return allowed, enclave
+
+    def next_expiration(self, access_control_ids, user_id):
+        """Earliest time.time() at which a grant of the user on the access controls expires, None if none will."""
+        if not isinstance(access_control_ids, list):
+            access_control_ids = [access_control_ids]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        earliest = None
+        for access_control_id in access_control_ids:
+            for permissions, expiration in self.entries.get((access_control_id, user_id), ()):
+                if expiration is not None and self.is_unexpired(expiration, now):
+                    if expiration.tzinfo is None:
+                        expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+                    timestamp = expiration.timestamp()
+                    earliest = timestamp if earliest is None else min(earliest, timestamp)
+        return earliest
+
+    @staticmethod
+    def is_unexpired(expiration, now):
+        if expiration is None:
+            return True
+        if not isinstance(expiration, datetime.datetime):
+            # Same as $gt against $$NOW, values of another type never compare as greater
+            return False
+        if expiration.tzinfo is None:
+            # pymongo returns naive UTC datetimes unless the client is tz aware
+            expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+        return expiration > now
+
+    # =============================================================================
+    # Index maintenance
+    # =============================================================================
+
+    @staticmethod
+    def index_document(document):
+        entries = {}
+        for user in document.get("users") or []:
+            if "userId" not in user or "expiration" not in user:
+                # A missing expiration is neither null nor later than $$NOW in the original pipelines
+                continue
+            key = (document["_id"], user["userId"])
+            entries.setdefault(key, []).append((frozenset(user.get("permissions") or []), user["expiration"]))
+        return {key: tuple(value) for key, value in entries.items()}
+
+    def reload(self):
+        entries, users = {}, {}
+        for document in self.collection.find({}, {"users": 1}):
+            indexed = self.index_document(document)
+            entries.update(indexed)
+            users[document["_id"]] = [user_id for _, user_id in indexed]
+        with self.lock:
+            self.entries, self.users = entries, users
+        self.notify(None)
+
+    def refresh(self):
+        if self.feed.live:
+            # The change stream was just opened, writes made since the initial load were not followed
+            self.reload()
+        else:
+            self.notify(None)
+
+    def apply_change(self, change):
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            document = change.get("fullDocument")
+            if document is None:
+                # The document was deleted again before its update could be looked up
+                return
+            indexed = self.index_document(document)
+            with self.lock:
+                self.remove(document["_id"])
+                self.entries.update(indexed)
+                self.users[document["_id"]] = [user_id for _, user_id in indexed]
+            self.notify(document["_id"])
+        elif operation == "delete":
+            with self.lock:
+                self.remove(change["documentKey"]["_id"])
+            self.notify(change["documentKey"]["_id"])
+        else:
+            # drop, rename or invalidate
+            self.reload()
+
+    def remove(self, document_id):
+        for user_id in self.users.pop(document_id, ()):
+            self.entries.pop((document_id, user_id), None)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, access_control_id):
+        for listener in self.listeners:
+            listener(access_control_id)
@@ -0,0 +1,240 @@
+import asyncio
+import copy
+import ssl
+from TLS_helper import FRAME_HEADER, FRAME_MESSAGE, FRAME_CHUNK, FRAME_END, FRAME_TYPE_MASK, FRAME_BSON, STREAM_CHUNK_SIZE, MAX_FRAME_SIZE, MAX_MESSAGE_SIZE
+from tools import JSON_CODEC, BSON_CODEC, encode_message, decode_message
+from tracing import tracer
+
+class AsyncTLSHelper:
+    """
+    asyncio counterpart of TLSHelper built on the standard library ssl streams.
+    It speaks the same framed protocol, so both helpers can be mixed on the two ends of a connection.
+    Servers require a client certificate issued by the CA. Clients present their certificate when they
+    have one and check the host name of the server, the certificates of this proof of concept are issued
+    to a name and not to the host address, so a client can pin the certificate of its server instead.
+    """
+    def __init__(self, ca_cert_file, self_cert_file=None, key_file=None, is_server=False, chunk_size=STREAM_CHUNK_SIZE, max_frame_size=MAX_FRAME_SIZE, codec=JSON_CODEC, server_hostname=None, pinned_cert_file=None, max_message_size=MAX_MESSAGE_SIZE):
+        self.pinned_cert = None
+        if is_server:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(self_cert_file, key_file)
+        else:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            if self_cert_file:
+                self.context.load_cert_chain(self_cert_file, key_file)
+            if pinned_cert_file:
+                # The pinned certificate identifies the server in place of its name
+                with open(pinned_cert_file) as file:
+                    self.pinned_cert = ssl.PEM_cert_to_DER_cert(file.read())
+                self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_REQUIRED
+        self.context.minimum_version = ssl.TLSVersion.TLSv1_3
+        self.context.load_verify_locations(ca_cert_file)
+        self.server_hostname = server_hostname
+        self.is_server = is_server
+        self.reader = None
+        self.writer = None
+        self.server = None
+        self.chunk_size = chunk_size
+        self.max_frame_size = max_frame_size
+        self.max_message_size = max_message_size
+        self.codec = codec
+
+    async def connect(self, host, port):
+        """Connects to a server or, on the server side, waits for the first client like TLSHelper.connect."""
+        if self.is_server:
+            accepted = asyncio.get_running_loop().create_future()
+
+            async def on_client(reader, writer):
+                if accepted.done():
+                    writer.close()
+                    return
+                accepted.set_result((reader, writer))
+
+            self.server = await asyncio.start_server(on_client, host, port, ssl=self.context, reuse_address=True)
+            self.reader, self.writer = await accepted
+            self.server.close()
+            self.server = None
+            return
+        max_tries = 30
+        delay = 1  # seconds between retries
+        for attempt in range(max_tries):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(host, port, ssl=self.context, server_hostname=self.server_hostname or host)
+            except ssl.SSLCertVerificationError:
+                raise
+            except Exception:
+                await asyncio.sleep(delay)
+                continue
+            await self.check_pinned_cert()
+            return
+        raise ConnectionError("Failed to establish connection after multiple attempts")
+
+    async def check_pinned_cert(self):
+        if self.pinned_cert is None:
+            return
+        if self.writer.get_extra_info("ssl_object").getpeercert(binary_form=True) != self.pinned_cert:
+            await self.close()
+            raise ConnectionError("The server certificate does not match the pinned certificate")
+
+    async def serve(self, host, port, handler, backlog=1024):
+        """Serves every client with handler(connection) as its own task until close() is called."""
+        async def on_client(reader, writer):
+            connection = copy.copy(self)
+            connection.reader, connection.writer, connection.server = reader, writer, None
+            try:
+                await handler(connection)
+            except asyncio.CancelledError:
+                # Cancelled with the event loop, the stream callback of the task would report it as an error
+                pass
+            finally:
+                await connection.close()
+
+        self.server = await asyncio.start_server(on_client, host, port, ssl=self.context, reuse_address=True, backlog=backlog)
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    # =============================================================================
+    # Sending
+    # =============================================================================
+
+    async def send(self, message, flags=0):
+        if not self.writer:
+            raise ConnectionError("No active connection to send data")
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        if len(message) > self.chunk_size:
+            view = memoryview(message)
+            await self.send_stream((view[offset:offset + self.chunk_size] for offset in range(0, len(view), self.chunk_size)), flags)
+        else:
+            await self.send_frame(FRAME_MESSAGE | flags, message)
+
+    async def send_message(self, message):
+        """Sends a dict with the codec negotiated on this connection, with the trace id of the query being served."""
+        if tracer.enabled:
+            trace_id = tracer.get_trace_id()
+            if trace_id is not None:
+                message = dict(message, trace_id=trace_id)
+        await self.send(encode_message(message, self.codec), FRAME_BSON if self.codec == BSON_CODEC else 0)
+
+    async def send_stream(self, chunks, flags=0):
+        """Sends an iterable, or async iterable, of byte chunks as one streamed message."""
+        if not self.writer:
+            raise ConnectionError("No active connection to send data")
+        if hasattr(chunks, "__aiter__"):
+            async for chunk in chunks:
+                await self.send_chunk(chunk, flags)
+        else:
+            for chunk in chunks:
+                await self.send_chunk(chunk, flags)
+        await self.send_frame(FRAME_END | flags, b"")
+
+    async def send_chunk(self, chunk, flags=0):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if len(chunk) > 0:
+            await self.send_frame(FRAME_CHUNK | flags, chunk)
+
+    async def send_frame(self, frame_type, payload):
+        if len(payload) > self.max_frame_size:
+            raise ValueError(f"Frame of {len(payload)} bytes exceeds the {self.max_frame_size} bytes limit")
+        self.writer.write(FRAME_HEADER.pack(frame_type, len(payload)))
+        self.writer.write(payload)
+        await self.writer.drain()
+
+    # =============================================================================
+    # Receiving
+    # =============================================================================
+
+    async def receive(self):
+        flags, payload = await self.receive_payload()
+        return payload.decode('utf-8')
+
+    async def receive_message(self):
+        """
+        Receives a dict, a server adopts the codec chosen by its client for its answers and the trace id
+        of the request for its spans.
+        """
+        flags, payload = await self.receive_payload()
+        codec = BSON_CODEC if flags & FRAME_BSON else JSON_CODEC
+        if self.is_server:
+            self.codec = codec
+        message = decode_message(payload, codec)
+        trace_id = message.pop("trace_id", None)
+        if self.is_server and tracer.enabled:
+            tracer.set_trace_id(trace_id)
+        return message
+
+    async def receive_payload(self):
+        """Returns the flags and the payload of the next message, streamed messages are reassembled up to max_message_size bytes."""
+        if not self.reader:
+            raise ConnectionError("No active connection to receive data")
+        frame_type, payload = await self.receive_frame()
+        flags = frame_type & ~FRAME_TYPE_MASK
+        frame_type &= FRAME_TYPE_MASK
+        if frame_type == FRAME_CHUNK:
+            message = bytearray(payload)
+            async for chunk in self.receive_stream():
+                if len(message) + len(chunk) > self.max_message_size:
+                    raise ConnectionError(f"Streamed message exceeds the {self.max_message_size} bytes limit")
+                message += chunk
+            payload = message
+        elif frame_type != FRAME_MESSAGE:
+            raise ConnectionError(f"Unexpected frame type {frame_type}")
+        return flags, payload
+
+    async def receive_stream(self):
+        """Yields the chunks of a streamed message until its end frame is received."""
+        if not self.reader:
+            raise ConnectionError("No active connection to receive data")
+        while True:
+            frame_type, payload = await self.receive_frame()
+            frame_type &= FRAME_TYPE_MASK
+            if frame_type == FRAME_END:
+                return
+            if frame_type != FRAME_CHUNK:
+                raise ConnectionError(f"Unexpected frame type {frame_type} in stream")
+            yield payload
+
+    async def receive_frame(self):
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+            frame_type, length = FRAME_HEADER.unpack(header)
+            if length > self.max_frame_size:
+                raise ConnectionError(f"Announced frame of {length} bytes exceeds the {self.max_frame_size} bytes limit")
+            return frame_type, await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed by peer")
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            self.server = None
+        if self.writer:
+            writer = self.writer
+            self.reader = None
+            self.writer = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+class BlockingConnection:
+    """
+    TLSHelper like facade of an AsyncTLSHelper connection for request handlers that run on worker
+    threads, the calls are carried out on the event loop of the connection.
+    """
+    def __init__(self, connection, loop):
+        self.connection = connection
+        self.loop = loop
+
+    def send_message(self, message):
+        asyncio.run_coroutine_threadsafe(self.connection.send_message(message), self.loop).result()
+
+    def close(self):
+        # Not waited for, close() may be called from the event loop itself
+        asyncio.run_coroutine_threadsafe(self.connection.close(), self.loop)
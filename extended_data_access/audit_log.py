@@ -0,0 +1,163 @@
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+class AuditLog:
+    """
+    Append only audit trail written by a background thread. Recording a query only appends to a deque,
+    the writer drains it every flush_interval seconds, writes the records of a batch as compact JSON lines
+    and closes the batch with a chain line holding the hash of the previous batch and of this one.
+    Editing, removing or reordering any record breaks the chain, see verify_chain.
+    The file is fsynced at most every fsync_interval seconds.
+    """
+    CHAIN_FIELDS = {"batch", "count", "prev", "hash"}
+
+    def __init__(self, path, flush_interval=0.05, fsync_interval=1.0, max_batch=1024):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_batch = max_batch
+        # deque.append and popleft are atomic, the request threads never wait for the writer
+        self.pending = deque()
+        self.previous_hash, self.batches = self.read_chain_end(path)
+        self.file = open(path, "ab")
+        self.last_fsync = time.monotonic()
+        self.write_lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.write_periodically, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, **fields):
+        self.pending.append((time.time(), fields))
+
+    # =============================================================================
+    # Writer
+    # =============================================================================
+
+    def write_periodically(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error occurred: {str(e)}")
+
+    def flush(self, fsync=False):
+        """Writes everything recorded so far, the writer thread and close() both call it."""
+        with self.write_lock:
+            if self.file is None:
+                return
+            while self.pending:
+                self.write_batch()
+            if fsync or time.monotonic() - self.last_fsync >= self.fsync_interval:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.monotonic()
+
+    def write_batch(self):
+        lines = []
+        while self.pending and len(lines) < self.max_batch:
+            timestamp, fields = self.pending.popleft()
+            lines.append(self.encode(dict(fields, t=timestamp)))
+        records = b"".join(lines)
+        batch_hash = hashlib.sha256(self.previous_hash.encode() + records).hexdigest()
+        chain = self.encode({"batch": self.batches, "count": len(lines), "prev": self.previous_hash, "hash": batch_hash})
+        self.file.write(records + chain)
+        self.previous_hash = batch_hash
+        self.batches += 1
+
+    @staticmethod
+    def encode(record):
+        return json.dumps(record, separators=(",", ":"), default=str).encode() + b"\n"
+
+    def close(self):
+        self.running = False
+        self.flush(fsync=True)
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    # =============================================================================
+    # Chain
+    # =============================================================================
+
+    @classmethod
+    def read_chain_end(cls, path):
+        """
+        Hash and number of the next batch of an existing log so that the chain goes on across restarts.
+        A batch torn by a crash, records or a partial line after the last chain line, is moved to a .torn
+        file next to the log and cut from it, the chain then goes on from the last complete batch.
+        """
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return "", 0
+        with open(path, "r+b") as file:
+            chain, chain_end = cls.find_last_chain(file)
+            size = file.seek(0, os.SEEK_END)
+            if chain_end < size:
+                file.seek(chain_end)
+                with open(path + ".torn", "ab") as torn:
+                    torn.write(file.read())
+                file.truncate(chain_end)
+                print(f"Audit log {path}: moved {size - chain_end} bytes after the last complete batch to {path}.torn")
+        if chain is None:
+            return "", 0
+        return chain["hash"], chain["batch"] + 1
+
+    @classmethod
+    def find_last_chain(cls, file, window=4096):
+        """Returns the last chain line of the file and the offset right after it, (None, 0) without any."""
+        size = file.seek(0, os.SEEK_END)
+        while True:
+            start = max(0, size - window)
+            file.seek(start)
+            data = file.read()
+            lines = data.split(b"\n")
+            # The last piece follows the last newline, it is empty unless the last write was torn, and the
+            # first one may start before the window
+            offset = len(data) - len(lines[-1])
+            for index in range(len(lines) - 2, -1 if start == 0 else 0, -1):
+                chain = cls.parse_chain(lines[index])
+                if chain is not None:
+                    return chain, start + offset
+                offset -= len(lines[index]) + 1
+            if start == 0:
+                return None, 0
+            window *= 4
+
+    @classmethod
+    def parse_chain(cls, line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return None
+        if isinstance(record, dict) and record.keys() == cls.CHAIN_FIELDS:
+            return record
+        return None
+
+    @classmethod
+    def verify_chain(cls, path):
+        """Returns the number of verified batches, raises ValueError at the first broken link."""
+        previous_hash = ""
+        records = []
+        batches = 0
+        with open(path, "rb") as file:
+            for line in file:
+                record = json.loads(line)
+                if record.keys() != cls.CHAIN_FIELDS:
+                    records.append(line)
+                    continue
+                batch_hash = hashlib.sha256(previous_hash.encode() + b"".join(records)).hexdigest()
+                if record["prev"] != previous_hash or record["hash"] != batch_hash or record["count"] != len(records):
+                    raise ValueError(f"Audit chain broken at batch {record.get('batch')}")
+                previous_hash = batch_hash
+                records = []
+                batches += 1
+        if records:
+            raise ValueError("Records found after the last batch")
+        return batches
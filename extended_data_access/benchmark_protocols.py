@@ -0,0 +1,80 @@
+import statistics
+import sys
+import threading
+import time
+from client import Client
+from tee_db_proxy import TEE_DB_Proxy
+from verifier import Verifier
+from client_tee import ClientTEE
+from TLS_helper import TLSHelper
+
+from tools import generate_message_from_lists
+
+# Compares the sequential and the batched attestation protocols: messages sent between the parties and
+# latency of a query that has to attest both TEEs. Loopback hops are almost free, one_way_delay_ms adds
+# a network delay to every message. Usage: python benchmark_protocols.py [queries] [one_way_delay_ms]
+
+host = "127.0.0.1"
+ca_cert_file = "certs/ca-cert.pem"
+server_key_file = "certs/server-key.pem"
+server_cert_file = "certs/server-cert.pem"
+queries = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+one_way_delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+
+# Every message sent by any party over TLS is one network hop
+sent = {"messages": 0}
+sent_lock = threading.Lock()
+send_message = TLSHelper.send_message
+
+def counting_send_message(self, message):
+    with sent_lock:
+        sent["messages"] += 1
+    if one_way_delay:
+        time.sleep(one_way_delay)
+    return send_message(self, message)
+
+TLSHelper.send_message = counting_send_message
+
+query = generate_message_from_lists(["method", "route", "username", "password", "params"], ["GET", "is_bp_above_mean", "external1", "password", {"patient_id": "111111111111111111111111"}])
+
+def run(protocol, base_port):
+    verifier_port, other_verifier_port, tee_port, client_tee_port = range(base_port, base_port + 4)
+    verifier = Verifier(ca_cert_file, server_cert_file, server_key_file)
+    tee_db_proxy = TEE_DB_Proxy(ca_cert_file, server_cert_file, server_key_file, verifier.get_public_key())
+    client_tee = ClientTEE(ca_cert_file, server_cert_file, server_key_file, tee_db_proxy.get_public_key(), verifier.get_public_key(), protocol=protocol)
+    client = Client(ca_cert_file)
+    verifier.set_tee_public_key(tee_db_proxy.get_public_key())
+    verifier.set_client_tee_public_key(client_tee.get_public_key())
+    client.set_personal_tee_public_key(client_tee.get_public_key())
+
+    threading.Thread(target=verifier.start, args=(host, verifier_port, other_verifier_port), daemon=True).start()
+    threading.Thread(target=tee_db_proxy.serve, args=(host, tee_port, host, other_verifier_port), daemon=True).start()
+    threading.Thread(target=client_tee.start, args=(host, client_tee_port, host, tee_port, host, verifier_port), kwargs={"session": True}, daemon=True).start()
+    client.open_session(host, client_tee_port)
+    print(protocol, "result:", client.query(dict(query)))
+
+    latencies = []
+    messages = []
+    for _ in range(queries):
+        # Forget the attestations of the session so that every query goes through the attestation protocol
+        client_tee.attestations.clear()
+        with sent_lock:
+            sent["messages"] = 0
+        start = time.perf_counter()
+        client.query(dict(query))
+        latencies.append(time.perf_counter() - start)
+        with sent_lock:
+            messages.append(sent["messages"])
+    client.close_session()
+    return latencies, messages
+
+results = {}
+for base_port, protocol in zip((12350, 12360), ("sequential", "batched")):
+    results[protocol] = run(protocol, base_port)
+    time.sleep(1)
+
+print(f"{'protocol':<12}{'messages/query':>16}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+for protocol, (latencies, messages) in results.items():
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(f"{protocol:<12}{statistics.mean(messages):>16.2f}{statistics.mean(latencies) * 1000:>10.2f}{statistics.median(latencies) * 1000:>10.2f}{p95 * 1000:>10.2f}")
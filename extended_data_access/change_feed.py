@@ -0,0 +1,77 @@
+import threading
+import time
+from pymongo.errors import PyMongoError
+
+# Version counter of every followed collection, keyed by collection name in the database of the collection
+VERSIONS_COLLECTION = "catalog_versions"
+
+def read_version(collection):
+    version = collection.database[VERSIONS_COLLECTION].find_one({"_id": collection.name})
+    return version["version"] if version else None
+
+def bump_version(collection):
+    """Called by the writers of a followed collection, polling feeds then reload it at their next poll."""
+    collection.database[VERSIONS_COLLECTION].update_one({"_id": collection.name}, {"$inc": {"version": 1}}, upsert=True)
+
+class ChangeFeed:
+    """
+    Follows the changes of a collection on a background thread and hands every change event to on_change.
+    Change streams require a replica set, on a standalone server the feed falls back to polling: every
+    poll_interval seconds it calls on_reload when the version counter of the collection moved, see
+    bump_version, or when the last reload is older than max_staleness seconds, so that the writes of a
+    writer that does not bump the counter are seen as well. live tells whether a change stream is followed.
+    The feed is created before the initial load of its owner, the version is then read before the data,
+    and on_reload is also called once the change stream is open for the writes made in between.
+    With images the events carry the document as it was before and after the change rather than as it is
+    when the event is read, when the collection records them (changeStreamPreAndPostImages).
+    """
+    def __init__(self, collection, on_change, on_reload, poll_interval=5, max_staleness=60, images=False):
+        self.collection = collection
+        self.on_change = on_change
+        self.on_reload = on_reload
+        self.poll_interval = poll_interval
+        self.max_staleness = max_staleness
+        if images:
+            self.watch_options = {"full_document": "whenAvailable", "full_document_before_change": "whenAvailable"}
+        else:
+            self.watch_options = {"full_document": "updateLookup"}
+        self.version = read_version(collection)
+        self.reloaded = time.monotonic()
+        self.live = False
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.follow, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def follow(self):
+        try:
+            with self.collection.watch(max_await_time_ms=500, **self.watch_options) as stream:
+                self.live = True
+                self.on_reload()
+                while self.running:
+                    change = stream.try_next()
+                    if change is not None:
+                        self.on_change(change)
+        except PyMongoError:
+            self.live = False
+            self.poll()
+
+    def poll(self):
+        while self.running:
+            time.sleep(self.poll_interval)
+            try:
+                version = read_version(self.collection)
+                stale = self.max_staleness is not None and time.monotonic() - self.reloaded >= self.max_staleness
+                if version != self.version or stale:
+                    # Read before reloading, a write made during the reload moves it again
+                    self.version = version
+                    self.reloaded = time.monotonic()
+                    self.on_reload()
+            except PyMongoError as e:
+                print(f"Error occurred: {str(e)}")
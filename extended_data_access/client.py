@@ -1,40 +1,52 @@
-import base64
 import json
 import time
 from TLS_helper import TLSHelper
-from tools import generate_json_from_lists
+from tools import generate_message_from_lists, verify_detached, JSON_CODEC
+from tracing import tracer
 
 class Client:
-    def __init__(self, ca_cert_file):
-        self.connection_with_peronal_tee = TLSHelper(ca_cert_file, is_server=False)
+    def __init__(self, ca_cert_file, codec=JSON_CODEC):
+        self.connection_with_peronal_tee = TLSHelper(ca_cert_file, is_server=False, codec=codec)
         self.personal_tee_public_key = None
         
     def set_personal_tee_public_key(self, personal_tee_public_key): 
         self.personal_tee_public_key = personal_tee_public_key
         
     def start(self, personal_tee_host, personal_tee_port, query):
-        self.connection_with_peronal_tee.connect(personal_tee_host, personal_tee_port)
-        response = self.send_query(query)
-        response = self.read_response(response)
+        self.open_session(personal_tee_host, personal_tee_port)
+        response = self.query(query)
         self.stop()
         return response
+
+    def open_session(self, personal_tee_host, personal_tee_port):
+        """Opens a connection that can carry many queries, the personal TEE must be started in session mode."""
+        self.connection_with_peronal_tee.connect(personal_tee_host, personal_tee_port)
+
+    def query(self, query):
+        tracer.start_trace()
+        with tracer.span("Client", "query"):
+            response = self.send_query(query)
+            return self.read_response(response)
+
+    def close_session(self):
+        self.stop()
     
     def send_query(self, query):
         print(query)
-        self.connection_with_peronal_tee.send(query)
-        response = self.connection_with_peronal_tee.receive()
+        if isinstance(query, str):
+            query = json.loads(query)
+        self.connection_with_peronal_tee.send_message(query)
+        response = self.connection_with_peronal_tee.receive_message()
         return response
     
     def read_response(self, response):
-        response = json.loads(response)["result"]
-        response = base64.b64decode(response)
-        response = self.personal_tee_public_key.verify(response)
+        response = verify_detached(self.personal_tee_public_key, response["result"], response["signature"])
         return response
         
     def stop(self):
         try:            
-            close_request = generate_json_from_lists(["close"], ["close"])
-            self.connection_with_peronal_tee.send(close_request)
+            close_request = generate_message_from_lists(["close"], ["close"])
+            self.connection_with_peronal_tee.send_message(close_request)
             self.connection_with_peronal_tee.close()    
         except:
             pass
\ No newline at end of file
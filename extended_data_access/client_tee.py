@@ -3,51 +3,91 @@ import datetime
 import inspect
 import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import dotenv
 from TLS_helper import TLSHelper
+from pipeline_template import PipelineTemplate
+from pipeline_catalog import PipelineCatalog
+from running_aggregate import RunningAggregate
+from nonce_pool import NoncePool
+from tracing import tracer
 from nacl.signing import SigningKey
 from nacl.hash import sha256
-from pymongo import MongoClient
-from tools import generate_json_from_lists, prepare_bytes_for_json, from_json_to_bytes
+from storage import open_storage, run_stages
+from tools import generate_message_from_lists, bind_nonce, sign_detached, verify_detached, receive_result, JSON_CODEC
 
 class ClientTEE:
     # =============================================================================
     # Setup
     # =============================================================================
-    def __init__(self, ca_cert_file, self_cert_file, key_file, db_proxy_public_key, verifier_public_key):
-        self.connection_with_verifier = TLSHelper(ca_cert_file, self_cert_file, key_file, is_server=False)
-        self.connection_with_db_proxy = TLSHelper(ca_cert_file, self_cert_file, key_file, is_server=False)
+    def __init__(self, ca_cert_file, self_cert_file, key_file, db_proxy_public_key, verifier_public_key, codec=JSON_CODEC, protocol="sequential", nonce_batch=16, storage=None):
+        """
+        protocol selects the attestation flow. "sequential" is the original one, evidences and attestations
+        are exchanged one at a time. "batched" sends the evidence of this TEE along the query, the DB proxy
+        then gets both TEEs attested in a single exchange with the verifier and returns its attestation with
+        the result. The credentials of the query then reach the DB proxy before its attestation is checked,
+        the result is only used once it is, see the readme. Both take their nonces from a pool refilled in
+        the background by batches of nonce_batch.
+        storage replaces the MongoDB server, a MemoryStorage for instance, see open_storage for the default.
+        """
+        if protocol not in ("sequential", "batched"):
+            raise ValueError(f"Unknown protocol: {protocol}")
+        self.connection_with_verifier = TLSHelper(ca_cert_file, self_cert_file, key_file, is_server=False, codec=codec)
+        self.connection_with_db_proxy = TLSHelper(ca_cert_file, self_cert_file, key_file, is_server=False, codec=codec)
         self.connection_with_client = TLSHelper(ca_cert_file, self_cert_file, key_file, is_server=True)
         self.verifier_public_key = verifier_public_key
         self.db_tee_public_key = db_proxy_public_key
         self.private_signing_key = SigningKey.generate()
         self.public_signing_key = self.private_signing_key.verify_key
+        # The code measurement only changes with the code itself, each evidence then only binds its nonce
+        self.source_code_digest = sha256(inspect.getsource(ClientTEE).encode())
         self.listening = False
         self.loaded_pipeline = None
+        self.loaded_template = None
+        # Compiled templates keyed by pipeline name, recompiled only when the digest in the catalog changes
+        self.templates = {}
+        # Runs the steps of a query that do not wait on the same peer as the main thread, one pool per run
+        self.workers = None
         self.methods = {"get_height": "get_height", "is_bp_above_mean": "get_bp"}
-        client = MongoClient('localhost', 27017)
+        client = storage if storage is not None else open_storage()
         db = client['data']
         self.bp = db['bp']
-        self.pipelines = db['pipelines']
+        # Running mean of the bp collection, the $group of is_bp_above_mean no longer scans it per query
+        self.bp_aggregate = RunningAggregate(self.bp, "bp")
+        self.pipelines = PipelineCatalog(db['pipelines'])
         self.nonce_freshness = None
+        self.session = False
+        self.attestations = {}
+        self.protocol = protocol
+        # The nonce pool refills itself on the verifier connection, exchanges on it must not interleave
+        self.verifier_lock = threading.Lock()
+        self.nonce_pool = NoncePool(self.request_nonces, batch_size=nonce_batch)
         
     def get_public_key(self):
         return self.public_signing_key
     
-    def start(self, client_host, client_port, tee_host, tee_port, verifier_host, verifier_port):
+    def start(self, client_host, client_port, tee_host, tee_port, verifier_host, verifier_port, session=False):
+        """
+        In session mode the connections stay open after a query and the attestations are reused
+        for the following queries of the client until they expire.
+        """
+        self.session = session
+        self.attestations = {}
+        self.workers = ThreadPoolExecutor(max_workers=2)
         self.connection_with_client.connect(client_host, client_port)
         self.connection_with_verifier.connect(verifier_host, verifier_port)
+        self.nonce_pool.start()
         self.connection_with_db_proxy.connect(tee_host, tee_port)
         self.listening = True
         
         while self.listening:
-            request = self.connection_with_client.receive()
-            self.dispatch_request(request)
+            request_json = self.connection_with_client.receive_message()
+            self.dispatch_request(request_json)
             
-    def dispatch_request(self, request):
-        request_json = json.loads(request)
+    def dispatch_request(self, request_json):
         try:
             if request_json["method"] == "GET":
                 if request_json["route"] in self.methods:
@@ -63,54 +103,120 @@ class ClientTEE:
     # =============================================================================
             
     def execute_query(self, request_json):
-        self.loaded_pipeline = self.pipelines.find_one({"name": request_json["route"]})
+        """
+        The independent steps overlap: the pipeline is loaded during the nonce and evidence round trips,
+        and this TEE signs its own evidence while the verifier checks the evidence of the DB proxy.
+        """
+        pipeline_loaded = self.workers.submit(self.load_pipeline, request_json["route"])
         query_name = self.methods[request_json["route"]]
-        nonce = self.request_nonce()
-        self.nonce_freshness = time.time()
-        evidence_requested = self.request_evidence(nonce, query_name)
-        attestation = self.send_evidence(evidence_requested, nonce, query_name)
-        if not self.verify_attestation(attestation):
-            print("Attestation verification failed")
-            self.stop()
-        evidence_generated = self.generate_evidence(evidence_requested)
-        response = self.send_query(request_json, evidence_generated, evidence_requested)
+        if self.session_is_attested(query_name):
+            pipeline_loaded.result()
+            with tracer.span("ClientTEE", "query"):
+                response = self.send_query(request_json)
+        elif self.protocol == "batched":
+            response = self.execute_batched_query(request_json, pipeline_loaded)
+            if response is None:
+                return
+        else:
+            with tracer.span("ClientTEE", "nonce"):
+                nonce, self.nonce_freshness = self.nonce_pool.take()
+            with tracer.span("ClientTEE", "evidence"):
+                evidence_requested = self.request_evidence(nonce, query_name)
+            pipeline_loaded.result()
+            evidence_generated = self.workers.submit(self.generate_evidence, evidence_requested["requested_nonce"])
+            with tracer.span("ClientTEE", "attestation"):
+                attestation = self.send_evidence(evidence_requested, nonce, query_name)
+                expiration = self.verify_attestation(attestation)
+            if not expiration:
+                print("Attestation verification failed")
+                self.stop()
+                return
+            evidence_generated = evidence_generated.result()
+            with tracer.span("ClientTEE", "query"):
+                response = self.send_query(request_json, evidence_generated, evidence_requested["requested_nonce"])
+            if self.session:
+                self.attestations[query_name] = expiration
         response = self.verify_response(response)
-        if not response:
+        if response is None:
             print("Response verification failed")
             self.stop()
-        response = self.process_response(response)
-        response = self.sign_response(response)
-        self.send_response(response)
-        self.stop()
+            return
+        with tracer.span("ClientTEE", "aggregate"):
+            response = self.process_response(response)
+        with tracer.span("ClientTEE", "sign"):
+            response = self.sign_response(response)
+        with tracer.span("ClientTEE", "send"):
+            self.send_response(response)
+        if not self.session:
+            self.stop()
+
+    def execute_batched_query(self, request_json, pipeline_loaded):
+        """
+        One round trip with the DB proxy: the query carries the evidence of this TEE and the nonce the DB
+        proxy binds its evidence to, the result comes back with the attestation of the DB proxy. That
+        attestation is relayed by the DB proxy itself, so it is only accepted when bound to this nonce.
+        """
+        query_name = self.methods[request_json["route"]]
+        with tracer.span("ClientTEE", "nonce"):
+            (own_nonce, own_fetched_at), (proxy_nonce, proxy_fetched_at) = self.nonce_pool.take(), self.nonce_pool.take()
+        # Freshness is counted from the oldest nonce bound to the attestations
+        self.nonce_freshness = min(own_fetched_at, proxy_fetched_at)
+        pipeline_loaded.result()
+        with tracer.span("ClientTEE", "evidence"):
+            evidence_generated = self.generate_evidence(own_nonce)
+        request_json["proxy_nonce"] = proxy_nonce
+        with tracer.span("ClientTEE", "query"):
+            response = self.send_query(request_json, evidence_generated, own_nonce)
+        with tracer.span("ClientTEE", "attestation"):
+            expiration = self.verify_attestation(response)
+            if expiration and not self.attestation_is_bound(response, proxy_nonce):
+                expiration = False
+        if not expiration:
+            print("Attestation verification failed")
+            self.stop()
+            return None
+        if self.session:
+            self.attestations[query_name] = expiration
+        return response
+
+    def load_pipeline(self, name):
+        self.loaded_template = self.load_template(name)
+        self.loaded_pipeline = name
+
+    def session_is_attested(self, query_name):
+        # The DB proxy attests this TEE after it was attested itself, so its attestation outlives ours
+        expiration = self.attestations.get(query_name)
+        return self.session and expiration is not None and time.time() < expiration
         
     # =============================================================================
     # Nonce request
     # =============================================================================
         
-    def request_nonce(self):
-        request = generate_json_from_lists(["method", "route"], ["GET", "nonce"])
-        self.connection_with_verifier.send(request)
-        return self.connection_with_verifier.receive()
+    def request_nonces(self, count):
+        request = generate_message_from_lists(["method", "route", "count"], ["GET", "nonces", count])
+        with self.verifier_lock:
+            self.connection_with_verifier.send_message(request)
+            response = self.connection_with_verifier.receive_message()
+        return response["nonces"], response["lifetime"]
     
     # =============================================================================
     # Requesting and sending evidence
     # =============================================================================
     
     def request_evidence(self, nonce, query_name):
-        nonce = json.loads(nonce)["nonce"]
-        request = generate_json_from_lists(["method", "route", "nonce", "query_name"], ["GET", "evidence", nonce, query_name])
-        self.connection_with_db_proxy.send(request)
-        return self.connection_with_db_proxy.receive()
+        request = generate_message_from_lists(["method", "route", "nonce", "query_name"], ["GET", "evidence", nonce, query_name])
+        self.connection_with_db_proxy.send_message(request)
+        return self.connection_with_db_proxy.receive_message()
 
     def send_evidence(self, evidence, nonce, query_name):
-        evidence = json.loads(evidence)
         source_code_claim = evidence["source_code_claim"]
         loaded_pipeline_claim = evidence["loaded_pipeline_claim"]
         nonce = evidence["received_nonce"]
 
-        request = generate_json_from_lists(["method", "route", "source_code_claim", "loaded_pipeline_claim", "nonce", "query_name"], ["GET", "attestation", source_code_claim, loaded_pipeline_claim, nonce, query_name])
-        self.connection_with_verifier.send(request)
-        return self.connection_with_verifier.receive()
+        request = generate_message_from_lists(["method", "route", "source_code_claim", "loaded_pipeline_claim", "nonce", "query_name"], ["GET", "attestation", source_code_claim, loaded_pipeline_claim, nonce, query_name])
+        with self.verifier_lock:
+            self.connection_with_verifier.send_message(request)
+            return self.connection_with_verifier.receive_message()
     
     # =============================================================================
     # Attestation verification
@@ -118,30 +224,40 @@ class ClientTEE:
     
     def verify_attestation(self, attestation):
         try:
-            attestation = json.loads(attestation)
             attestation_signature = attestation['attestation']
-            attestation_signature = base64.b64decode(attestation_signature)
             attestation = self.verifier_public_key.verify(attestation_signature)
             expiration = json.loads(attestation)["expiration"]
             if time.time() > expiration:
                 return False
             if time.time() - self.nonce_freshness > 300:
                 return False
-            return True
+            return expiration
         except Exception as e:
             print(f"Error occurred: {str(e)}")
             
+    def attestation_is_bound(self, attestation, nonce):
+        """
+        Whether the attested pipeline claim of the DB proxy is bound to nonce, an attestation replayed from
+        an earlier query is not. The verifier only attests a claim made for an approved pipeline, the DB
+        proxy reports the digest of that pipeline along the attestation and the claim must bind it to
+        nonce. The digest needs no signature, a claim bound to another nonce matches no digest.
+        """
+        try:
+            attested = json.loads(self.verifier_public_key.verify(attestation['attestation']))
+            claim = self.db_tee_public_key.verify(base64.b64decode(attested["loaded_pipeline_claim"]))
+            return claim == bind_nonce(attestation["pipeline_digest"], nonce)
+        except Exception as e:
+            print(f"Error occurred: {str(e)}")
+            return False
+
     # =============================================================================
     # Evidence self generation
     # =============================================================================
     
-    def generate_evidence(self, evidence_requested):
-        nonce = json.loads(evidence_requested)["requested_nonce"]
-        nonce = json.loads(nonce)["nonce"]
-        source_code = inspect.getsource(ClientTEE)
-        source_code_hash = sha256(source_code.encode() + from_json_to_bytes(nonce))
+    def generate_evidence(self, nonce):
+        source_code_hash = bind_nonce(self.source_code_digest, nonce)
         signed_source_code_claim = self.private_signing_key.sign(source_code_hash)
-        loaded_pipeline_hash = sha256(str(self.loaded_pipeline["pipeline"]).encode() + from_json_to_bytes(nonce))
+        loaded_pipeline_hash = bind_nonce(self.loaded_template.digest, nonce)
 
         signed_loaded_pipeline_claim = self.private_signing_key.sign(loaded_pipeline_hash)
         
@@ -151,47 +267,60 @@ class ClientTEE:
     # Sending query and evidence
     # =============================================================================
         
-    def send_query(self, query, evidence_generated, evidence_requested):
-        query["source_code_claim"] = prepare_bytes_for_json(evidence_generated[0])
-        query["loaded_pipeline_claim"] = prepare_bytes_for_json(evidence_generated[1])
-        nonce = json.loads(evidence_requested)["requested_nonce"]
-        query["nonce"] = json.loads(nonce)["nonce"]
+    def send_query(self, query, evidence_generated=None, nonce=None):
+        if evidence_generated is not None:
+            query["source_code_claim"] = evidence_generated[0]
+            query["loaded_pipeline_claim"] = evidence_generated[1]
+            query["nonce"] = nonce
         query["route"] = self.methods[query["route"]]
-        query["loaded_pipeline"] = self.loaded_pipeline["name"]
-        query = json.dumps(query)
-        self.connection_with_db_proxy.send(query)
-        return self.connection_with_db_proxy.receive()
+        query["loaded_pipeline"] = self.loaded_pipeline
+        self.connection_with_db_proxy.send_message(query)
+        return receive_result(self.connection_with_db_proxy)
     
     # =============================================================================
     # Response verification and processing
     # =============================================================================
     
-    def verify_response(self, response):   
+    def verify_response(self, response):
+        """Returns the verified result, None when the DB proxy reported an error or the signature is invalid."""
+        if "error" in response:
+            print(f"Error occurred: {response['error']}")
+            return None
         try:
-            response = json.loads(response)
-            decoded_response = base64.b64decode(response["result"])
-            verified_response = self.db_tee_public_key.verify(decoded_response)
+            verified_response = verify_detached(self.db_tee_public_key, response["result"], response["signature"])
             return verified_response
         except Exception as e:
-            return str(e)
+            print(f"Error occurred: {str(e)}")
+            return None
     
     def process_response(self, response):
         data = response.decode('utf-8')
         data = json.loads(data)
         data = data[0]['bp']
         pipeline = self.build_pipeline({"input_bp": data})
-        response = list(self.bp.aggregate(pipeline))
-        return response
+        return self.run_pipeline(pipeline)
+
+    def run_pipeline(self, pipeline):
+        """
+        Runs the loaded pipeline, the attested one, on the bp collection. Its leading $group over the whole
+        collection is answered by the running aggregate when it can, the following stages then run here on
+        the grouped document, otherwise the whole pipeline runs in the database.
+        """
+        if pipeline and "$group" in pipeline[0] and not any("$lookup" in stage for stage in pipeline[1:]):
+            grouped = self.bp_aggregate.group(pipeline[0]["$group"])
+            if grouped is not None:
+                return run_stages(None, grouped, pipeline[1:])
+        return list(self.bp.aggregate(pipeline))
     
     def sign_response(self, response):
         response = json.dumps(response)
         response = response.encode()
-        signed_response = self.private_signing_key.sign(response)
-        return signed_response
+        signature = sign_detached(self.private_signing_key, response)
+        return response, signature
     
     def send_response(self, response):
-        response = generate_json_from_lists(["result"], [prepare_bytes_for_json(response)])
-        self.connection_with_client.send(response)
+        response = generate_message_from_lists(["result", "signature"], list(response))
+        self.connection_with_client.send_message(response)
     
     
     # =============================================================================
@@ -202,21 +331,17 @@ class ClientTEE:
         for param_name, param_value in params.items():
             params[param_name] = self.validate_param(param_name, param_value)
 
-        def replace_placeholders(obj):
-            if isinstance(obj, dict):
-                # Recursively process dictionaries
-                return {key: replace_placeholders(value) for key, value in obj.items()}
-            elif isinstance(obj, list):
-                # Recursively process lists
-                return [replace_placeholders(item) for item in obj]
-            elif isinstance(obj, str) and obj.startswith("$"):
-                # Replace placeholders that match keys in params
-                placeholder = obj[1:]  # Remove leading $
-                validated_value = params.get(placeholder, obj)
-                return validated_value  # Replace if key exists in params
-            return obj
-        self.loaded_pipeline = self.loaded_pipeline["pipeline"]
-        return replace_placeholders(self.loaded_pipeline)
+        return self.loaded_template.render(params)
+
+    def load_template(self, name):
+        template = self.templates.get(name)
+        if template is None or template.digest != self.pipelines.digest(name):
+            pipeline = self.pipelines.get(name)
+            if pipeline is None:
+                raise ValueError(f"Unknown pipeline: {name}")
+            template = PipelineTemplate(pipeline)
+            self.templates[name] = template
+        return template
 
     
     def validate_param(self, param_name, param_value):
@@ -230,11 +355,16 @@ class ClientTEE:
 
     def stop(self):
         self.listening = False
+        self.nonce_pool.stop()
+        if self.workers:
+            self.workers.shutdown(wait=False)
+            self.workers = None
         try:
-            close_request = generate_json_from_lists(["close"], ["close"])
-            self.connection_with_verifier.send(close_request)
-            self.connection_with_db_proxy.send(close_request)
-            self.connection_with_client.send(close_request)
+            close_request = generate_message_from_lists(["close"], ["close"])
+            with self.verifier_lock:
+                self.connection_with_verifier.send_message(close_request)
+            self.connection_with_db_proxy.send_message(close_request)
+            self.connection_with_client.send_message(close_request)
             self.connection_with_verifier.close()
             self.connection_with_db_proxy.close()
             self.connection_with_client.close()
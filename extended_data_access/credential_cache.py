@@ -0,0 +1,92 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from change_feed import ChangeFeed
+
+class CredentialCache:
+    """
+    Bounded cache of the users authenticated recently, safe to share between threads.
+    Passwords are never kept: an entry holds an HMAC of the verified password under a key drawn for
+    this process and the user document without its password. Entries live ttl seconds, the least
+    recently used entry is evicted when the cache is full, and the entries of a user are dropped as soon
+    as the change feed of the users collection reports a change of its document. Without change streams
+    the cache is cleared at every poll, so that a changed password or a deleted user stops authenticating
+    within poll_interval seconds even when its writer does not bump the version of the collection.
+    """
+    def __init__(self, collection, ttl=300, capacity=10000, poll_interval=5):
+        self.collection = collection
+        self.ttl = ttl
+        self.capacity = capacity
+        self.key = os.urandom(32)
+        self.entries = OrderedDict()
+        self.usernames = {}
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "evicted": 0, "invalidated": 0}
+        self.feed = ChangeFeed(collection, self.apply_change, self.clear, poll_interval, max_staleness=poll_interval)
+        self.feed.start()
+
+    def authenticate(self, username, password):
+        """Returns the user without its password, or None when the credentials are invalid."""
+        credential = hmac.new(self.key, password.encode(), hashlib.sha256).digest()
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is not None:
+                cached_credential, user, expiration = entry
+                if time.monotonic() < expiration and hmac.compare_digest(cached_credential, credential):
+                    self.entries.move_to_end(username)
+                    self.metrics["hits"] += 1
+                    return user
+            self.metrics["misses"] += 1
+        user = self.collection.find_one({"username": username, "password": password}, {"password": 0})
+        if user is not None:
+            self.add(username, credential, user)
+        return user
+
+    def add(self, username, credential, user):
+        with self.lock:
+            self.discard(username)
+            if len(self.entries) >= self.capacity:
+                _, entry = self.entries.popitem(last=False)
+                self.usernames.pop(entry[1]["_id"], None)
+                self.metrics["evicted"] += 1
+            self.entries[username] = (credential, user, time.monotonic() + self.ttl)
+            self.usernames[user["_id"]] = username
+
+    def discard(self, username):
+        entry = self.entries.pop(username, None)
+        if entry is not None:
+            self.usernames.pop(entry[1]["_id"], None)
+
+    # =============================================================================
+    # Invalidation
+    # =============================================================================
+
+    def invalidate(self, user_id):
+        with self.lock:
+            username = self.usernames.pop(user_id, None)
+            if username is not None:
+                self.entries.pop(username, None)
+                self.metrics["invalidated"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.metrics["invalidated"] += len(self.entries)
+            self.entries.clear()
+            self.usernames.clear()
+
+    def apply_change(self, change):
+        if "documentKey" in change:
+            self.invalidate(change["documentKey"]["_id"])
+        else:
+            # drop, rename or invalidate
+            self.clear()
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics, cached=len(self.entries), capacity=self.capacity)
+
+    def __len__(self):
+        return len(self.entries)
@@ -6,7 +6,7 @@ from tee_db_proxy import TEE_DB_Proxy
 from verifier import Verifier
 from client_tee import ClientTEE
 
-from tools import generate_json_from_lists
+from tools import generate_message_from_lists
 
 host = "127.0.0.1"
 client_port = 12345
@@ -41,7 +41,7 @@ def handle_client(query, result_queue):
 def handle_client_tee():
     client_tee.start(host, client_tee_port, host, tee_port, host, verifier_port)
     
-query = generate_json_from_lists(["method", "route", "username", "password", "params"], ["GET", "is_bp_above_mean", "external1", "password", {"patient_id": "111111111111111111111111"}])
+query = generate_message_from_lists(["method", "route", "username", "password", "params"], ["GET", "is_bp_above_mean", "external1", "password", {"patient_id": "111111111111111111111111"}])
 
 result_queue = queue.Queue()  
 for i in range(100):
@@ -60,5 +60,5 @@ for i in range(100):
 
     print("Result:", result_queue.get(), i)
     time.sleep(2)
-        
 
+verifier.close()
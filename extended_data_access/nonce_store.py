@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+class NonceStore:
+    """
+    Bounded store of the nonces waiting for their evidence, safe to share between threads.
+    Every nonce gets the same lifetime, so insertion order is also expiry order: the store acts as a
+    single slot time wheel whose expired nonces are evicted from the front in O(1).
+    A nonce can only be consumed once.
+    """
+    def __init__(self, lifetime=300, capacity=100000):
+        self.lifetime = lifetime
+        self.capacity = capacity
+        self.nonces = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {"issued": 0, "consumed": 0, "rejected": 0, "expired": 0, "evicted": 0}
+
+    def add(self, nonce):
+        with self.lock:
+            now = time.monotonic()
+            self.evict_expired(now)
+            if len(self.nonces) >= self.capacity:
+                # Under overload the oldest pending nonce is the least likely to still be used
+                self.nonces.popitem(last=False)
+                self.metrics["evicted"] += 1
+            self.nonces[nonce] = now + self.lifetime
+            self.metrics["issued"] += 1
+
+    def consume(self, nonce):
+        """Removes the nonce and tells whether it was pending and still fresh."""
+        with self.lock:
+            expiration = self.nonces.pop(nonce, None)
+            if expiration is None or time.monotonic() > expiration:
+                if expiration is not None:
+                    self.metrics["expired"] += 1
+                self.metrics["rejected"] += 1
+                return False
+            self.metrics["consumed"] += 1
+            return True
+
+    def evict_expired(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self.nonces:
+            nonce, expiration = next(iter(self.nonces.items()))
+            if expiration > now:
+                break
+            self.nonces.popitem(last=False)
+            self.metrics["expired"] += 1
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics, pending=len(self.nonces), capacity=self.capacity)
+
+    def __len__(self):
+        return len(self.nonces)
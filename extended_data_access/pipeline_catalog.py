@@ -0,0 +1,74 @@
+import threading
+from nacl.hash import sha256
+from change_feed import ChangeFeed, bump_version
+
+class PipelineCatalog:
+    """
+    In-memory index of the approved pipelines keyed by name, every entry holds the pipeline and its
+    precomputed digest. The index is updated document by document from the change feed of the collection
+    and, when change streams are not available, reloaded whenever the version of the collection moves or
+    every max_staleness seconds, see ChangeFeed.
+    """
+    def __init__(self, collection, poll_interval=5, max_staleness=60):
+        self.collection = collection
+        self.lock = threading.Lock()
+        self.pipelines = {}
+        self.digests = {}
+        self.names = {}
+        self.feed = ChangeFeed(collection, self.apply_change, self.reload, poll_interval, max_staleness)
+        self.reload()
+        self.feed.start()
+
+    def get(self, name):
+        return self.pipelines.get(name)
+
+    def digest(self, name):
+        return self.digests.get(name)
+
+    @staticmethod
+    def compute_digest(pipeline):
+        return sha256(str(pipeline).encode())
+
+    # =============================================================================
+    # Index maintenance
+    # =============================================================================
+
+    def reload(self):
+        pipelines, digests, names = {}, {}, {}
+        for document in self.collection.find({}, {"name": 1, "pipeline": 1}):
+            pipelines[document["name"]] = document["pipeline"]
+            digests[document["name"]] = self.compute_digest(document["pipeline"])
+            names[document["_id"]] = document["name"]
+        with self.lock:
+            self.pipelines, self.digests, self.names = pipelines, digests, names
+
+    def apply_change(self, change):
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            document = change.get("fullDocument")
+            if document is None:
+                # The document was deleted again before its update could be looked up
+                return
+            self.remove(document["_id"])
+            with self.lock:
+                self.pipelines[document["name"]] = document["pipeline"]
+                self.digests[document["name"]] = self.compute_digest(document["pipeline"])
+                self.names[document["_id"]] = document["name"]
+        elif operation == "delete":
+            self.remove(change["documentKey"]["_id"])
+        else:
+            # drop, rename or invalidate
+            self.reload()
+
+    def remove(self, document_id):
+        with self.lock:
+            name = self.names.pop(document_id, None)
+            if name is not None:
+                self.pipelines.pop(name, None)
+                self.digests.pop(name, None)
+
+    @staticmethod
+    def publish(collection, name, pipeline):
+        """Stores an approved pipeline and moves the version of the collection so that polling catalogs reload it."""
+        collection.replace_one({"name": name}, {"name": name, "pipeline": pipeline}, upsert=True)
+        bump_version(collection)
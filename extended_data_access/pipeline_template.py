@@ -0,0 +1,69 @@
+from nacl.hash import sha256
+
+class PipelineTemplate:
+    """
+    Pipeline compiled once at load time. Compiling records the path of every "$name" string, which is
+    a parameter slot when a parameter of that name is given. Rendering a query then only copies the
+    containers leading to the filled slots and shares every other node with the stored pipeline.
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.digest = sha256(str(pipeline).encode())
+        self.slots = self.compile(pipeline)
+        # Slot trees restricted to the parameters actually given, keyed by the set of parameter names
+        self.plans = {}
+
+    @classmethod
+    def compile(cls, obj):
+        """Returns a tree of the slot paths in obj, its leaves are the parameter names, or None without slots."""
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, list):
+            items = enumerate(obj)
+        elif isinstance(obj, str) and obj.startswith("$"):
+            return obj[1:]
+        else:
+            return None
+        slots = {}
+        for key, value in items:
+            child = cls.compile(value)
+            if child is not None:
+                slots[key] = child
+        return slots or None
+
+    def render(self, params):
+        """Returns the pipeline with the slots named in params replaced, the result must not be mutated."""
+        names = frozenset(params)
+        plan = self.plans.get(names, False)
+        if plan is False:
+            plan = self.prune(self.slots, names)
+            self.plans[names] = plan
+        if plan is None:
+            return self.pipeline
+        return self.fill(self.pipeline, plan, params)
+
+    @classmethod
+    def prune(cls, slots, names):
+        """Drops the slots that no given parameter fills, field references such as "$bp" mostly."""
+        if slots is None or isinstance(slots, str):
+            return slots if slots in names else None
+        pruned = {}
+        for key, child in slots.items():
+            child = cls.prune(child, names)
+            if child is not None:
+                pruned[key] = child
+        return pruned or None
+
+    @classmethod
+    def fill(cls, obj, slots, params):
+        if isinstance(slots, str):
+            return params.get(slots, obj)
+        copy = None
+        for key, child in slots.items():
+            value = obj[key]
+            filled = cls.fill(value, child, params)
+            if filled is not value:
+                if copy is None:
+                    copy = obj.copy()
+                copy[key] = filled
+        return obj if copy is None else copy
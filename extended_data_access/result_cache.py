@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+from change_feed import ChangeFeed
+
+class ResultCache:
+    """
+    LRU cache of signed query results bounded both in entries and in bytes, safe to share between threads.
+    Keys hold the pipeline digest, the validated parameters and the data version of the queried collection,
+    so a write to that collection makes the older entries unreachable until they are evicted. Entries are
+    also tagged with what they depend on besides the collection, access controls for instance, so that
+    invalidate(tag) drops exactly the affected results, and expire at the latest after ttl seconds.
+    """
+
+    def __init__(self, capacity_bytes=64 * 1024 * 1024, capacity=10000, ttl=60):
+        self.capacity_bytes = capacity_bytes
+        self.max_entry_size = capacity_bytes // 16
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.size = 0
+        # Moves on every invalidation, a result computed across one is not stored
+        self.generation = 0
+        self.versions = {}
+        self.feeds = []
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "evicted": 0, "invalidated": 0}
+
+    def key(self, digest, params, collection_name):
+        return digest, repr(sorted(params.items())), collection_name, self.versions.get(collection_name, 0)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() >= entry[3]:
+                if entry is not None:
+                    self.discard(key)
+                self.metrics["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.metrics["hits"] += 1
+            return entry[0]
+
+    def put(self, key, signed_result, tags=(), valid_until=None, generation=None):
+        """
+        Stores a (result, signature) pair until valid_until, a time.time() value, or ttl seconds at most.
+        generation is the value read before computing the result.
+        """
+        size = sum(len(part) for part in signed_result)
+        if size > self.max_entry_size:
+            return
+        expiration = time.time() + self.ttl
+        if valid_until is not None:
+            expiration = min(expiration, valid_until)
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.discard(key)
+            while self.entries and (len(self.entries) >= self.capacity or self.size + size > self.capacity_bytes):
+                self.discard(next(iter(self.entries)))
+                self.metrics["evicted"] += 1
+            self.entries[key] = (signed_result, size, tuple(tags), expiration)
+            self.size += size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    # =============================================================================
+    # Invalidation
+    # =============================================================================
+
+    def invalidate(self, tag):
+        with self.lock:
+            self.generation += 1
+            for key in list(self.tags.get(tag, ())):
+                self.discard(key)
+                self.metrics["invalidated"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.metrics["invalidated"] += len(self.entries)
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
+    def bump(self, collection_name):
+        """Moves the data version of a collection, its cached results are then never returned again."""
+        with self.lock:
+            self.versions[collection_name] = self.versions.get(collection_name, 0) + 1
+
+    def watch(self, collection, poll_interval=5):
+        """
+        Bumps the data version of the collection on every change. Without change streams it is bumped at
+        every poll, results are then at most poll_interval seconds older than the collection.
+        """
+        def bump(change=None):
+            self.bump(collection.name)
+
+        feed = ChangeFeed(collection, bump, bump, poll_interval, max_staleness=poll_interval)
+        feed.start()
+        self.feeds.append(feed)
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics, cached=len(self.entries), size=self.size, capacity_bytes=self.capacity_bytes)
+
+    def __len__(self):
+        return len(self.entries)
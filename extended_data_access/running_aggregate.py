@@ -0,0 +1,196 @@
+import math
+import threading
+from numbers import Number
+from change_feed import ChangeFeed
+
+class RunningAggregate:
+    """
+    Number of documents, and count, sum and sum of squares of a numeric field over a whole collection.
+    The change feed follows the collection with the images of the changed documents, so an insert adds
+    the new value, a delete removes the old one and an update or a replace swaps them. A change whose
+    images are missing, the collection does not record them (changeStreamPreAndPostImages) or they
+    expired, schedules a recompute instead. A recompute also runs every recompute_interval seconds to
+    correct the floating point drift of the running sums, and without change streams whenever the
+    version of the collection moves or the sums are older than max_staleness seconds, see ChangeFeed.
+    The recompute scans the collection in _id order. Changes reported during the scan to documents past
+    the last one scanned were not seen by it and are applied to its sums, which assumes that new documents
+    get increasing ids, as the ObjectIds generated by the drivers do. Whether the scan saw the other ones
+    is not known, the running sums are then kept when they are exact, and another recompute runs otherwise.
+    """
+    def __init__(self, collection, field, recompute_interval=300, poll_interval=5, max_staleness=60, chunk_size=10000):
+        self.collection = collection
+        self.field = field
+        self.recompute_interval = recompute_interval
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        # Serializes the recomputes of the background thread and of the constructor
+        self.recompute_lock = threading.Lock()
+        self.recompute_requested = threading.Event()
+        self.documents = 0
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        # Whether the sums followed every change since the last recompute they were set by
+        self.exact = False
+        # (_id, operation, old value, new value) of the changes reported while a recompute scans the
+        # collection, None otherwise
+        self.buffered = None
+        # Whether a change reported during the scan could not be applied
+        self.missed = False
+        self.feed = ChangeFeed(collection, self.apply_change, self.request_recompute, poll_interval, max_staleness, images=True)
+        self.recompute()
+        self.feed.start()
+        threading.Thread(target=self.recompute_periodically, daemon=True).start()
+
+    # =============================================================================
+    # Reading
+    # =============================================================================
+
+    def mean(self):
+        """Mean of the field like $avg, None when no document holds a number."""
+        with self.lock:
+            return self.total / self.count if self.count else None
+
+    def variance(self):
+        with self.lock:
+            if not self.count:
+                return None
+            mean = self.total / self.count
+            return max(self.squares / self.count - mean * mean, 0.0)
+
+    def group(self, spec):
+        """
+        Output documents of the $group stage spec over the whole collection, or None when the running sums
+        can not answer it. Only a constant _id with {"$avg": "$<field>"} and {"$sum": 1} accumulators is
+        answered, their results are the ones of the stage.
+        """
+        key = spec.get("_id")
+        if isinstance(key, (dict, list)) or (isinstance(key, str) and key.startswith("$")):
+            return None
+        accumulators = {name: accumulator for name, accumulator in spec.items() if name != "_id"}
+        for accumulator in accumulators.values():
+            if accumulator not in ({"$avg": "$" + self.field}, {"$sum": 1}):
+                return None
+        with self.lock:
+            if not self.documents:
+                # $group does not output anything on an empty collection
+                return []
+            grouped = {"_id": key}
+            for name, accumulator in accumulators.items():
+                if "$avg" in accumulator:
+                    grouped[name] = self.total / self.count if self.count else None
+                else:
+                    grouped[name] = self.documents
+            return [grouped]
+
+    def get_metrics(self):
+        with self.lock:
+            return {"documents": self.documents, "count": self.count, "sum": self.total, "sum_of_squares": self.squares}
+
+    # =============================================================================
+    # Maintenance
+    # =============================================================================
+
+    def read_value(self, document):
+        value = document.get(self.field)
+        # $avg ignores missing and non numeric values, booleans included
+        if isinstance(value, bool) or not isinstance(value, Number):
+            return None
+        return float(value)
+
+    def apply_change(self, change):
+        operation = change["operationType"]
+        if operation not in ("insert", "update", "replace", "delete"):
+            # drop, rename or invalidate
+            self.request_recompute()
+            return
+        before = change.get("fullDocumentBeforeChange") if operation != "insert" else {}
+        after = change.get("fullDocument") if operation != "delete" else {}
+        if before is None or after is None:
+            with self.lock:
+                self.exact = False
+                if self.buffered is not None:
+                    self.missed = True
+            self.request_recompute()
+            return
+        old, new = self.read_value(before), self.read_value(after)
+        with self.lock:
+            self.apply_delta(operation, old, new)
+            if self.buffered is not None:
+                self.buffered.append((change["documentKey"]["_id"], operation, old, new))
+
+    def apply_delta(self, operation, old, new):
+        """Replaces the value old by new in the sums, None for a document without one, under the lock."""
+        self.documents += (operation == "insert") - (operation == "delete")
+        if old is not None:
+            self.count -= 1
+            self.total -= old
+            self.squares -= old * old
+        if new is not None:
+            self.count += 1
+            self.total += new
+            self.squares += new * new
+
+    def request_recompute(self):
+        self.recompute_requested.set()
+
+    def recompute(self):
+        with self.recompute_lock:
+            with self.lock:
+                self.buffered = []
+                self.missed = False
+            try:
+                documents, count, last_id = 0, 0, None
+                totals, squares = [], []
+                chunk = []
+                for document in self.collection.find({}, {self.field: 1}, sort=[("_id", 1)]):
+                    documents += 1
+                    last_id = document["_id"]
+                    value = self.read_value(document)
+                    if value is None:
+                        continue
+                    chunk.append(value)
+                    if len(chunk) >= self.chunk_size:
+                        count += len(chunk)
+                        totals.append(math.fsum(chunk))
+                        squares.append(math.fsum(value * value for value in chunk))
+                        chunk = []
+            except BaseException:
+                with self.lock:
+                    self.buffered = None
+                raise
+            with self.lock:
+                buffered, self.buffered = self.buffered, None
+                unordered = any(not self.is_after(document_id, last_id) for document_id, _, _, _ in buffered)
+                if unordered and self.exact:
+                    # The running sums followed every change, only their drift is left uncorrected
+                    return
+                count += len(chunk)
+                totals.append(math.fsum(chunk))
+                squares.append(math.fsum(value * value for value in chunk))
+                self.documents, self.count, self.total, self.squares = documents, count, math.fsum(totals), math.fsum(squares)
+                for document_id, operation, old, new in buffered:
+                    if self.is_after(document_id, last_id):
+                        self.apply_delta(operation, old, new)
+                self.exact = not (unordered or self.missed)
+            if unordered:
+                self.request_recompute()
+
+    @staticmethod
+    def is_after(document_id, last_id):
+        if last_id is None:
+            return True
+        try:
+            return document_id > last_id
+        except TypeError:
+            # _ids of another type than the last one scanned, BSON orders them by type first
+            return True
+
+    def recompute_periodically(self):
+        while self.feed.running:
+            self.recompute_requested.wait(self.recompute_interval)
+            self.recompute_requested.clear()
+            try:
+                self.recompute()
+            except Exception as e:
+                print(f"Error occurred: {str(e)}")
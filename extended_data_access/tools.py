@@ -1,6 +1,13 @@
 import base64
 import csv
+import hashlib
 import json
+import bson
+from bson import json_util
+from nacl.hash import sha256
+
+JSON_CODEC = "json"
+BSON_CODEC = "bson"
 
 
 def generate_json_from_lists(keys: list, values: list) -> str:
@@ -11,10 +18,72 @@ def prepare_bytes_for_json(data: bytes) -> str:
     """Encodes binary data for JSON transmission."""
     return base64.b64encode(data).decode('utf-8')
 
+def generate_message_from_lists(keys: list, values: list) -> dict:
+    """Generates a message to be sent with send_message from keys and values."""
+    return dict(zip(keys, values))
+
+def encode_message(message: dict, codec: str = JSON_CODEC) -> bytes:
+    """Serializes a message, binary values travel raw with BSON and as extended JSON base64 with JSON."""
+    if codec == BSON_CODEC:
+        return bson.encode(message)
+    return json_util.dumps(message).encode('utf-8')
+
+def decode_message(data, codec: str = JSON_CODEC) -> dict:
+    """Parses a message serialized with encode_message."""
+    if codec == BSON_CODEC:
+        return bson.decode(data)
+    return json_util.loads(data)
+
 def from_json_to_bytes(data: str) -> bytes:
     """Converts a JSON string to bytes."""
     return data.encode('utf-8')
 
+def bind_nonce(digest: bytes, nonce: str) -> bytes:
+    """Binds a measurement digest computed once at startup to a verifier nonce."""
+    return sha256(digest + from_json_to_bytes(nonce))
+
+def sign_detached(signing_key, payload: bytes) -> bytes:
+    """Signs the SHA-256 digest of a payload and returns only the 64 bytes signature."""
+    return sign_digest(signing_key, hashlib.sha256(payload).digest())
+
+def sign_digest(signing_key, digest: bytes) -> bytes:
+    """Same signature as sign_detached for a SHA-256 digest computed incrementally."""
+    return signing_key.sign(digest).signature
+
+def verify_detached(verify_key, payload: bytes, signature: bytes) -> bytes:
+    """Checks a signature made by sign_detached and returns the payload, raises BadSignatureError otherwise."""
+    verify_key.verify(hashlib.sha256(payload).digest(), signature)
+    return payload
+
+def receive_result(connection) -> dict:
+    """
+    Receives a signed result, either as one message or as a {"result_stream": True} message followed
+    by the streamed result and a {"signature": ...} message. Returns {"result", "signature"} either way,
+    along with any other field sent before the result. A stream that failed on the sender side is
+    followed by an {"error": ...} message instead of the signature, {"error"} is then returned.
+    """
+    response = connection.receive_message()
+    if not response.pop("result_stream", False):
+        return response
+    result = bytearray()
+    for chunk in connection.receive_stream():
+        result += chunk
+    trailer = connection.receive_message()
+    if "error" in trailer:
+        response["error"] = trailer["error"]
+        return response
+    response["result"] = bytes(result)
+    response["signature"] = trailer["signature"]
+    return response
+
+def get_path(document: dict, path: str, default=None):
+    """Reads a dotted path such as "data.metrics.height" from a document."""
+    for key in path.split("."):
+        if not isinstance(document, dict) or key not in document:
+            return default
+        document = document[key]
+    return document
+
 def write_data(file, data):
     """Writes binary data to a file."""
     with open(file, mode="a", newline="") as file:
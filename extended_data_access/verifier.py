@@ -1,39 +1,58 @@
-import base64
+import asyncio
 import json
 import time
 from TLS_helper import TLSHelper
+from async_TLS_helper import AsyncTLSHelper, BlockingConnection
 import inspect
 from tee_db_proxy import TEE_DB_Proxy
 from nacl.signing import SigningKey
 import nacl.utils, nacl.secret
-from tools import generate_json_from_lists, prepare_bytes_for_json, from_json_to_bytes
+from tools import generate_message_from_lists, prepare_bytes_for_json, bind_nonce
 from nacl.hash import sha256
 import threading
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor
+from storage import open_storage
+from pipeline_catalog import PipelineCatalog
+from nonce_store import NonceStore
+from batch_verifier import BatchVerifier
+from tracing import tracer
 from client_tee import ClientTEE
 
 class Verifier:
     # =============================================================================
     # Setup
     # =============================================================================
-    def __init__(self, ca_cert_file, self_cert_file, key_file):
+    def __init__(self, ca_cert_file, self_cert_file, key_file, nonce_capacity=100000, storage=None):
+        # Claims of all the connections are verified together, see get_metrics for its counters. Created
+        # first, its worker processes are forked before the storage client starts its threads
+        self.batch_verifier = BatchVerifier()
         self.connections = {}
         self.test = None
         self.connections["Client"] = TLSHelper(ca_cert_file, self_cert_file, key_file, is_server=True)
         self.connections["TEE"] = TLSHelper(ca_cert_file, self_cert_file, key_file, is_server=True)
-        self.db_proxy_source_code = inspect.getsource(TEE_DB_Proxy)
-        self.client_tee_source_code = inspect.getsource(ClientTEE)
+        self.tls_files = (ca_cert_file, self_cert_file, key_file)
+        # Listening helpers and event loop of serve_async
+        self.async_servers = []
+        self.loop = None
+        self.db_proxy_source_code_digest = sha256(inspect.getsource(TEE_DB_Proxy).encode())
+        self.client_tee_source_code_digest = sha256(inspect.getsource(ClientTEE).encode())
         self.tee_public_key = None
         self.client_tee_public_key = None
-        self.pending_verifications = {}
         self.expiration = 300
+        self.max_nonce_batch = 64
+        # Role whose public key and code measurement check the claims of each party
+        self.parties = {"db_proxy": "Client", "client_tee": "TEE"}
+        # Role of every open connection, "Client" for the client TEEs and "TEE" for the DB proxies
+        self.roles = {}
+        self.workers = None
+        self.pending_verifications = NonceStore(self.expiration, nonce_capacity)
         self.private_signing_key = SigningKey.generate()
         self.public_signing_key = self.private_signing_key.verify_key
         self.listening = False
         self.threads = {}
-        client = MongoClient('localhost', 27017)
+        client = storage if storage is not None else open_storage()
         db = client['pipelines']
-        self.approved_pipelines = db['approved_pipelines']
+        self.approved_pipelines = PipelineCatalog(db['approved_pipelines'])
         
     def set_tee_public_key(self, tee_public_key):
         self.tee_public_key = tee_public_key
@@ -43,41 +62,122 @@ class Verifier:
     
     def get_public_key(self):
         return self.public_signing_key
+
+    def get_metrics(self):
+        return {"nonces": self.pending_verifications.get_metrics(), "claims": self.batch_verifier.get_metrics()}
     
     def handle_connection(self, connection):
         while self.listening:
             try:
-                request = self.connections[connection].receive()
-                self.dispatch_request(request, connection)
+                request_json = connection.receive_message()
+                self.dispatch_request(request_json, connection)
             except:
                 self.stop()
                 
     def start(self, host, port, other_port):
         self.listening = True
-        self.connections["Client"].connect(host, port)
-        self.threads["Client"] = threading.Thread(target=self.handle_connection, args=("Client",))
-        self.threads["Client"].start()
-        self.connections["TEE"].connect(host, other_port)
-        self.threads["TEE"] = threading.Thread(target=self.handle_connection, args=("TEE",))
-        self.threads["TEE"].start()
-        
+        for role, role_port in (("Client", port), ("TEE", other_port)):
+            self.connections[role].connect(host, role_port)
+            self.roles[self.connections[role]] = role
+            self.threads[role] = threading.Thread(target=self.handle_connection, args=(self.connections[role],))
+            self.threads[role].start()
+
+    def serve(self, host, port, other_port, max_workers=64):
+        """
+        Long running server mode, any number of client TEEs connect on port and of DB proxies on other_port.
+        Every accepted connection is served by its own worker and closing it leaves the others open.
+        """
+        self.workers = ThreadPoolExecutor(max_workers=max_workers)
+        self.listening = True
+        self.connections["Client"].listen(host, port)
+        self.connections["TEE"].listen(host, other_port)
+        threading.Thread(target=self.accept_connections, args=("TEE",), daemon=True).start()
+        self.accept_connections("Client")
+
+    def accept_connections(self, role):
+        while self.listening:
+            try:
+                conn = self.connections[role].accept()
+            except OSError:
+                break
+            self.workers.submit(self.handle_accepted, conn, role)
+
+    def handle_accepted(self, conn, role):
+        try:
+            connection = self.connections[role].wrap_accepted(conn)
+        except Exception:
+            conn.close()
+            return
+        self.roles[connection] = role
+        try:
+            while self.listening and connection.socket_:
+                request_json = connection.receive_message()
+                self.dispatch_request(request_json, connection)
+        except Exception:
+            pass
+        finally:
+            self.close_connection(connection)
+
+    async def serve_async(self, host, port, other_port, max_workers=64):
+        """
+        Like serve on an event loop: the connections of both roles are tasks of the loop instead of blocked
+        workers, the workers only run the requests, which wait on the batch verifier. The client TEEs and
+        the DB proxies must present their certificate, see AsyncTLSHelper.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.workers = ThreadPoolExecutor(max_workers=max_workers)
+        self.listening = True
+        self.async_servers = [AsyncTLSHelper(*self.tls_files, is_server=True) for _ in range(2)]
+        await asyncio.gather(*(server.serve(host, role_port, lambda connection, role=role: self.handle_async(connection, role))
+                               for server, (role, role_port) in zip(self.async_servers, (("Client", port), ("TEE", other_port)))))
+
+    async def handle_async(self, async_connection, role):
+        connection = BlockingConnection(async_connection, self.loop)
+        self.roles[connection] = role
+        try:
+            while self.listening and async_connection.writer:
+                request_json = await async_connection.receive_message()
+                await self.loop.run_in_executor(self.workers, self.dispatch_request, request_json, connection)
+        except Exception:
+            pass
+        finally:
+            self.roles.pop(connection, None)
+
+    def close_connection(self, connection):
+        if self.workers is None:
+            self.stop()
+            return
+        self.roles.pop(connection, None)
+        try:
+            connection.close()
+        except Exception:
+            pass
         
-    def dispatch_request(self, request, connection):    
-        request_json = json.loads(request)
+    def dispatch_request(self, request_json, connection):
         try:
             if request_json["method"] == "GET":
                 if request_json["route"] == "nonce":
                     self.nonce_requested(connection)
                 if request_json["route"] == "attestation":
                     self.attestation_requested(request_json, connection)
+                if request_json["route"] == "nonces":
+                    self.nonces_requested(request_json, connection)
+                if request_json["route"] == "attestations":
+                    self.attestations_requested(request_json, connection)
             else:
-                self.stop()
+                self.close_connection(connection)
         except Exception as e:
-            self.connections[connection].send(json.dumps({"error": str(e)}))
-            self.stop()
+            connection.send_message({"error": str(e)})
+            self.close_connection(connection)
     
     def stop(self):
         self.listening = False
+        if self.workers:
+            self.workers.shutdown(wait=False)
+            self.workers = None
+        for server in self.async_servers:
+            asyncio.run_coroutine_threadsafe(server.close(), self.loop)
+        self.async_servers = []
         for thread in self.threads:
             try:
                 self.threads[thread].join()
@@ -88,82 +188,125 @@ class Verifier:
                 self.connections[connection].close()
         except Exception:
             pass
+        # Connections accepted in server mode, their workers are blocked on them
+        for connection in list(self.roles):
+            self.roles.pop(connection, None)
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def close(self):
+        """
+        Stops the verifier for good. stop only ends a run, start can be called again and the batch verifier
+        keeps its worker processes across the runs.
+        """
+        self.stop()
+        self.batch_verifier.close()
         
     # =============================================================================
     # Nonce Request
     # =============================================================================
     def nonce_requested(self, connection):
-        nonce = self.generate_nonce()
+        with tracer.span("Verifier", "nonce"):
+            nonce = self.generate_nonce()
         self.send_nonce(nonce, connection)
     
     def generate_nonce(self):
         nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
         self.test = nonce
-        self.pending_verifications[prepare_bytes_for_json(nonce)] = time.time()
+        self.pending_verifications.add(prepare_bytes_for_json(nonce))
         return nonce
     
     def send_nonce(self, nonce, connection):
         try:
-            response = generate_json_from_lists(["nonce"], [prepare_bytes_for_json(nonce)])
-            self.connections[connection].send(response)
+            response = generate_message_from_lists(["nonce"], [prepare_bytes_for_json(nonce)])
+            connection.send_message(response)
         except Exception as e:
             print(e)
         
+    def nonces_requested(self, request_json, connection):
+        """Issues up to max_nonce_batch nonces at once so that the parties can prefetch them, see NoncePool."""
+        count = max(1, min(int(request_json.get("count", 1)), self.max_nonce_batch))
+        with tracer.span("Verifier", "nonce"):
+            nonces = [prepare_bytes_for_json(self.generate_nonce()) for _ in range(count)]
+        connection.send_message({"nonces": nonces, "lifetime": self.expiration})
+        
     # =============================================================================
     # Attestation Request / Evidence Verification
     # =============================================================================
     def attestation_requested(self, request_json, connection):
-        attestation = self.verify_evidence(request_json, connection)
+        with tracer.span("Verifier", "attestation"):
+            attestation = self.verify_evidence(request_json, self.roles[connection])
         self.send_attestation(attestation, connection)
         
-    def verify_evidence(self, request_json, connection):
+    def attestations_requested(self, request_json, connection):
+        """
+        Batched protocol: the DB proxy forwards its own evidence and the evidence of the client TEE in one
+        request, each one is verified against the key and the code of its party.
+        """
+        evidences = [(evidence, self.parties[evidence["party"]]) for evidence in request_json["evidences"]]
+        with tracer.span("Verifier", "attestation"):
+            # All the claims are queued before waiting on any of them so that they are verified in one batch
+            pending = [self.submit_evidence(evidence, role) for evidence, role in evidences]
+            attestations = []
+            for (evidence, role), pending_claims in zip(evidences, pending):
+                attestation = self.check_evidence(evidence, role, pending_claims)
+                attestations.append({"party": evidence["party"], "attestation": attestation})
+        connection.send_message({"attestations": attestations})
+
+    def verify_evidence(self, request_json, role):
+        return self.check_evidence(request_json, role, self.submit_evidence(request_json, role))
+
+    def submit_evidence(self, request_json, role):
+        """Consumes the nonce and queues both claims, returns None when the nonce is not pending."""
+        source_code_claim = request_json["source_code_claim"]
+        loaded_pipeline_claim = request_json["loaded_pipeline_claim"]
+        if not self.pending_verifications.consume(request_json["nonce"]):
+            return None
+        return self.verify_claim(source_code_claim, role), self.verify_claim(loaded_pipeline_claim, role)
+
+    def check_evidence(self, request_json, role, pending_claims):
+        if pending_claims is None:
+            return False
         source_code_claim = request_json["source_code_claim"]
         loaded_pipeline_claim = request_json["loaded_pipeline_claim"]
         query_name = request_json["query_name"]
         nonce = request_json["nonce"]
-        if nonce not in self.pending_verifications:
-            return False
-        
-        if time.time() - self.pending_verifications[nonce] > self.expiration:
-            return False
-        received_source_code_claim = self.verify_claim(source_code_claim, connection)
-        received_loaded_pipeline_claim = self.verify_claim(loaded_pipeline_claim, connection)
+        received_source_code_claim = pending_claims[0].result()
+        received_loaded_pipeline_claim = pending_claims[1].result()
         
-        known_source_code_claim = self.compute_known_source_code_claim(nonce, connection)
+        known_source_code_claim = self.compute_known_source_code_claim(nonce, role)
         known_pipeline_claim = self.compute_known_pipeline_claim(nonce, query_name)
         if received_source_code_claim == known_source_code_claim and received_loaded_pipeline_claim == known_pipeline_claim:
             expiration = time.time() + self.expiration
-            evidence = {"expiration": expiration, "source_code_claim": source_code_claim, "loaded_pipeline_claim": loaded_pipeline_claim}
+            evidence = {"expiration": expiration, "source_code_claim": prepare_bytes_for_json(source_code_claim), "loaded_pipeline_claim": prepare_bytes_for_json(loaded_pipeline_claim)}
             evidence_json = json.dumps(evidence, separators=(',', ':')).encode('utf-8') 
             attestation = self.private_signing_key.sign(evidence_json)
             return attestation
         return False
 
-    def verify_claim(self, claim, connection): 
-        bytes_claim = base64.b64decode(claim)
-        if connection == "TEE":
-            return self.client_tee_public_key.verify(bytes_claim)
-        else:
-            return self.tee_public_key.verify(bytes_claim)
+    def verify_claim(self, claim, role):
+        """Queues the claim on the batch verifier, the returned future gives the verified message."""
+        public_key = self.client_tee_public_key if role == "TEE" else self.tee_public_key
+        return self.batch_verifier.submit(public_key, claim)
     
-    def compute_known_source_code_claim(self, nonce, connection):
-        if connection in self.connections:
-            if connection == "Client":
-                return sha256(self.db_proxy_source_code.encode() + from_json_to_bytes(nonce))
+    def compute_known_source_code_claim(self, nonce, role):
+        if role in self.connections:
+            if role == "Client":
+                return bind_nonce(self.db_proxy_source_code_digest, nonce)
             else:
-                return sha256(self.client_tee_source_code.encode() + from_json_to_bytes(nonce))
+                return bind_nonce(self.client_tee_source_code_digest, nonce)
         return False
 
     def compute_known_pipeline_claim(self, nonce, query_name):
-        try:
-            pipeline = self.approved_pipelines.find_one({"name": query_name})["pipeline"]
-            hash = sha256(str(pipeline).encode() + from_json_to_bytes(nonce))
-            return hash
-        except Exception as e:
+        digest = self.approved_pipelines.digest(query_name)
+        if digest is None:
             return False
+        return bind_nonce(digest, nonce)
     
     def send_attestation(self, attestation, connection):
-        response = generate_json_from_lists(["attestation"], [prepare_bytes_for_json(attestation)])
-        self.connections[connection].send(response)
+        response = generate_message_from_lists(["attestation"], [attestation])
+        connection.send_message(response)
         
     
\ No newline at end of file
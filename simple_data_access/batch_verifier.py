@@ -0,0 +1,169 @@
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from nacl.exceptions import BadSignatureError
+from nacl.signing import VerifyKey
+
+def verify_batch(claims):
+    """Runs in the worker processes, returns (True, message) for a valid claim and (False, None) otherwise."""
+    results = []
+    for public_key, claim in claims:
+        try:
+            results.append((True, VerifyKey(public_key).verify(claim)))
+        except BadSignatureError:
+            results.append((False, None))
+    return results
+
+class BatchVerifier:
+    """
+    Verifies Ed25519 signed claims in batches, safe to share between threads. submit() queues a claim and
+    returns a Future. A collector thread takes the queued claims, up to max_batch of them, and while
+    earlier batches are still being verified it waits up to max_delay seconds for more, a claim submitted
+    to an idle verifier is not held back. A batch of at least min_pool_batch claims is spread over a
+    process pool, smaller batches are verified by the collector itself, sending them to another process
+    costs more than it saves. The workers are forked when the verifier is created, before the parties
+    start their threads, spawning them instead would run the unguarded main.py drivers again.
+    The Future resolves to the signed message, or raises BadSignatureError like VerifyKey.verify.
+    """
+    def __init__(self, max_delay=0.002, max_batch=256, workers=None, min_pool_batch=16):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.min_pool_batch = min_pool_batch
+        self.pool = None
+        if self.workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+            # Forks every worker now
+            self.pool.submit(verify_batch, []).result()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # Chunks submitted to the pool and not verified yet
+        self.in_flight = 0
+        self.started = time.monotonic()
+        self.metrics = {"submitted": 0, "verified": 0, "rejected": 0, "batches": 0, "pooled_batches": 0, "max_queue_depth": 0}
+        self.running = True
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+
+    def submit(self, public_key, claim):
+        future = Future()
+        item = (bytes(public_key), bytes(claim), future)
+        with self.lock:
+            self.metrics["submitted"] += 1
+            if self.running:
+                self.queue.put(item)
+                self.metrics["max_queue_depth"] = max(self.metrics["max_queue_depth"], self.queue.qsize())
+                return future
+        # Closed, the claim is verified by the calling thread
+        self.resolve([item], verify_batch([item[:2]]))
+        return future
+
+    def verify(self, public_key, claim):
+        return self.submit(public_key, claim).result()
+
+    # =============================================================================
+    # Batching
+    # =============================================================================
+
+    def collect(self):
+        while self.running:
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.in_flight:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.dispatch(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def dispatch(self, batch):
+        with self.lock:
+            self.metrics["batches"] += 1
+        if self.pool is None or len(batch) < self.min_pool_batch:
+            self.resolve(batch, verify_batch([(public_key, claim) for public_key, claim, _ in batch]))
+            return
+        size = math.ceil(len(batch) / self.workers)
+        chunks = [batch[start:start + size] for start in range(0, len(batch), size)]
+        with self.lock:
+            self.metrics["pooled_batches"] += 1
+            self.in_flight += len(chunks)
+        for chunk in chunks:
+            verified = self.pool.submit(verify_batch, [(public_key, claim) for public_key, claim, _ in chunk])
+            verified.add_done_callback(lambda done, chunk=chunk: self.resolve_done(chunk, done))
+
+    def resolve_done(self, chunk, done):
+        with self.lock:
+            self.in_flight -= 1
+        try:
+            results = done.result()
+        except Exception as e:
+            for _, _, future in chunk:
+                future.set_exception(e)
+            return
+        self.resolve(chunk, results)
+
+    def resolve(self, chunk, results):
+        verified = 0
+        for (_, _, future), (valid, message) in zip(chunk, results):
+            if valid:
+                future.set_result(message)
+                verified += 1
+            else:
+                future.set_exception(BadSignatureError("Signature was forged or corrupt"))
+        with self.lock:
+            self.metrics["verified"] += verified
+            self.metrics["rejected"] += len(chunk) - verified
+
+    # =============================================================================
+    # Counters
+    # =============================================================================
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+        done = metrics["verified"] + metrics["rejected"]
+        elapsed = time.monotonic() - self.started
+        metrics["queue_depth"] = self.queue.qsize()
+        metrics["mean_batch_size"] = done / metrics["batches"] if metrics["batches"] else 0.0
+        metrics["throughput"] = done / elapsed if elapsed > 0 else 0.0
+        return metrics
+
+    def close(self):
+        """
+        Stops the collector and the pool, the claims still queued are verified first. Claims submitted
+        afterwards are verified by the submitting thread. Calling it again does nothing.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        while True:
+            try:
+                batch = [self.queue.get_nowait()]
+            except queue.Empty:
+                break
+            self.resolve(batch, verify_batch([batch[0][:2]]))
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -1,95 +1,125 @@
-import base64
 import json
+import threading
 import time
 from TLS_helper import TLSHelper
-from tools import generate_json_from_lists
+from tools import generate_message_from_lists, verify_detached, receive_result, JSON_CODEC
+from nonce_pool import NoncePool
+from tracing import tracer
 
 class Client:
-    def __init__(self, ca_cert_file, tee_public_key, verifier_public_key):
-        self.connection_with_verifier = TLSHelper(ca_cert_file, is_server=False)
-        self.connection_with_db_proxy = TLSHelper(ca_cert_file, is_server=False)
+    def __init__(self, ca_cert_file, tee_public_key, verifier_public_key, codec=JSON_CODEC):
+        self.connection_with_verifier = TLSHelper(ca_cert_file, is_server=False, codec=codec)
+        self.connection_with_db_proxy = TLSHelper(ca_cert_file, is_server=False, codec=codec)
         self.tee_public_key = tee_public_key
         self.verifier_public_key = verifier_public_key
         self.nonce_freshness = None
+        self.attestations = {}
+        # The nonce pool refills itself on the verifier connection, exchanges on it must not interleave
+        self.verifier_lock = threading.Lock()
+        self.nonce_pool = NoncePool(self.request_nonces)
     
     def start(self, tee_host, tee_port, verifier_host, verifier_port, query):
         try:
-            self.connection_with_verifier.connect(verifier_host, verifier_port)
-            self.connection_with_db_proxy.connect(tee_host, tee_port)
-            query = json.loads(query)
-            query_name = query["route"]
-            nonce = self.request_nonce()
-            self.nonce_freshness = time.time()
-            evidence = self.request_evidence(nonce, query_name)
-            attestation = self.send_evidence(evidence, nonce, query_name)
-            if self.verify_attestation(attestation):
-                query_result = self.send_query(query) 
-                if "route" in query_result and "evidence" in query_result:
-                    self.stop()
-                    return "Attestation required, access denied"
-                query_result = self.verify_response(query_result)
-                return query_result
-            else:
-                return "Attestation failed"
+            self.open_session(tee_host, tee_port, verifier_host, verifier_port)
+            return self.query(query)
         except Exception as e:
             print(f"Error occurred: {str(e)}")
             return str(e)
         finally:
             self.stop()
+
+    def open_session(self, tee_host, tee_port, verifier_host, verifier_port):
+        """Opens connections that can carry many queries, the DB proxy is attested once per query name until the attestation expires."""
+        self.connection_with_verifier.connect(verifier_host, verifier_port)
+        self.nonce_pool.start()
+        self.connection_with_db_proxy.connect(tee_host, tee_port)
+        self.attestations = {}
+
+    def query(self, query):
+        if isinstance(query, str):
+            query = json.loads(query)
+        query_name = query["route"]
+        tracer.start_trace()
+        if not self.session_is_attested(query_name):
+            with tracer.span("Client", "nonce"):
+                nonce, self.nonce_freshness = self.nonce_pool.take()
+            with tracer.span("Client", "evidence"):
+                evidence = self.request_evidence(nonce, query_name)
+            with tracer.span("Client", "attestation"):
+                attestation = self.send_evidence(evidence, nonce, query_name)
+                expiration = self.verify_attestation(attestation)
+            if not expiration:
+                return "Attestation failed"
+            self.attestations[query_name] = expiration
+        with tracer.span("Client", "query"):
+            query_result = self.send_query(query)
+        if "route" in query_result and "evidence" in query_result:
+            self.stop()
+            return "Attestation required, access denied"
+        return self.verify_response(query_result)
+
+    def session_is_attested(self, query_name):
+        expiration = self.attestations.get(query_name)
+        return expiration is not None and time.time() < expiration
+
+    def close_session(self):
+        self.stop()
     
-    def request_nonce(self):
-        request = generate_json_from_lists(["method", "route"], ["GET", "nonce"])
-        self.connection_with_verifier.send(request)
-        return self.connection_with_verifier.receive()
+    def request_nonces(self, count):
+        request = generate_message_from_lists(["method", "route", "count"], ["GET", "nonces", count])
+        with self.verifier_lock:
+            self.connection_with_verifier.send_message(request)
+            response = self.connection_with_verifier.receive_message()
+        return response["nonces"], response["lifetime"]
     
     def request_evidence(self, nonce, query_name):
-        nonce = json.loads(nonce)["nonce"]
-        request = generate_json_from_lists(["method", "route", "nonce", "query_name"], ["GET", "evidence", nonce, query_name])
-        self.connection_with_db_proxy.send(request)
-        return self.connection_with_db_proxy.receive()
+        request = generate_message_from_lists(["method", "route", "nonce", "query_name"], ["GET", "evidence", nonce, query_name])
+        self.connection_with_db_proxy.send_message(request)
+        return self.connection_with_db_proxy.receive_message()
         
     def send_evidence(self, evidence, nonce, query_name):
-        evidence = json.loads(evidence)
         source_code_claim = evidence["source_code_claim"]
         loaded_pipeline_claim = evidence["loaded_pipeline_claim"]
         nonce = evidence["nonce"]
-        request = generate_json_from_lists(["method", "route", "source_code_claim", "loaded_pipeline_claim", "nonce", "query_name"], ["GET", "attestation", source_code_claim, loaded_pipeline_claim, nonce, query_name])
-        self.connection_with_verifier.send(request)
-        return self.connection_with_verifier.receive()
+        request = generate_message_from_lists(["method", "route", "source_code_claim", "loaded_pipeline_claim", "nonce", "query_name"], ["GET", "attestation", source_code_claim, loaded_pipeline_claim, nonce, query_name])
+        with self.verifier_lock:
+            self.connection_with_verifier.send_message(request)
+            return self.connection_with_verifier.receive_message()
     
     def verify_attestation(self, attestation):
         try:
-            attestation = json.loads(attestation)
             attestation_signature = attestation['attestation']
-            attestation_signature = base64.b64decode(attestation_signature)
             attestation = self.verifier_public_key.verify(attestation_signature)
             expiration = json.loads(attestation)["expiration"]
             if time.time() > expiration:
                 return False
             if time.time() - self.nonce_freshness > 300:
                 return False
-            return True
+            return expiration
         except Exception as e:
             print(f"Error occurred: {str(e)}")
         
     def send_query(self, query):
-        self.connection_with_db_proxy.send(json.dumps(query))
-        return self.connection_with_db_proxy.receive()
+        self.connection_with_db_proxy.send_message(query)
+        return receive_result(self.connection_with_db_proxy)
     
     def verify_response(self, response):
+        if "error" in response:
+            # Reported by the DB proxy when the result stream failed, returned like the other failures
+            return response["error"]
         try:
-            response = json.loads(response)
-            decoded_response = base64.b64decode(response["result"])
-            verified_response = self.tee_public_key.verify(decoded_response)
+            verified_response = verify_detached(self.tee_public_key, response["result"], response["signature"])
             return verified_response
         except Exception as e:
             return str(e)
         
     def stop(self):
+        self.nonce_pool.stop()
         try:
-            close_request = generate_json_from_lists(["close"], ["close"])
-            self.connection_with_verifier.send(close_request)
-            self.connection_with_db_proxy.send(close_request)
+            close_request = generate_message_from_lists(["close"], ["close"])
+            with self.verifier_lock:
+                self.connection_with_verifier.send_message(close_request)
+            self.connection_with_db_proxy.send_message(close_request)
 
             self.connection_with_verifier.close()
             self.connection_with_db_proxy.close()
@@ -5,7 +5,7 @@ from client import Client
 from tee_db_proxy import TEE_DB_Proxy
 from verifier import Verifier
 
-from tools import generate_json_from_lists
+from tools import generate_message_from_lists
 
 host = "127.0.0.1"
 client_port = 12345
@@ -34,7 +34,7 @@ def handle_client(query, result_queue):
     result = client.start(host, tee_port, host, verifier_port, query)
     result_queue.put(result)
 for i in range(1):
-    query = generate_json_from_lists(["method", "route", "username", "password", "params"], ["GET", "get_bp", "doctor1", "password", {"patient_id": "111111111111111111111111"}])
+    query = generate_message_from_lists(["method", "route", "username", "password", "params"], ["GET", "get_bp", "doctor1", "password", {"patient_id": "111111111111111111111111"}])
     result_queue = queue.Queue()  
     verifier_thread = threading.Thread(target=handle_verifier)
     tee_thread = threading.Thread(target=handle_tee)
@@ -49,4 +49,6 @@ for i in range(1):
     tee_thread.join()
 
     print(result_queue.get(), i)
-    time.sleep(2)
\ No newline at end of file
+    time.sleep(2)
+
+verifier.close()
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import deque
+
+class NoncePool:
+    """
+    Verifier nonces fetched ahead of time in batches, safe to share between threads. fetch(count) requests
+    a batch from the verifier and returns (nonces, lifetime), a background thread calls it whenever the
+    pool falls below low_water so that taking a nonce does not wait on the verifier. Nonces are only handed
+    out during the first max_age_ratio of their lifetime at the verifier, the evidence bound to them then
+    still reaches it in time, older ones are dropped.
+    """
+    def __init__(self, fetch, batch_size=16, low_water=4, max_age_ratio=0.5):
+        self.fetch = fetch
+        self.batch_size = batch_size
+        self.low_water = max(1, min(low_water, batch_size))
+        self.max_age_ratio = max_age_ratio
+        self.max_age = None
+        # (nonce, time.time() the batch was requested at), oldest first
+        self.nonces = deque()
+        self.lock = threading.Lock()
+        self.refill_lock = threading.Lock()
+        self.refill_needed = threading.Event()
+        self.running = False
+        self.thread = None
+        self.metrics = {"fetched": 0, "batches": 0, "taken": 0, "stale": 0, "misses": 0}
+
+    def start(self):
+        if self.running:
+            return
+        with self.lock:
+            # Nonces of an earlier connection may not be pending at the verifier of this one
+            self.nonces.clear()
+        self.running = True
+        self.thread = threading.Thread(target=self.refill_periodically, daemon=True)
+        self.thread.start()
+        self.refill_needed.set()
+
+    def stop(self):
+        self.running = False
+        self.refill_needed.set()
+
+    def take(self):
+        """Returns a (nonce, fetched_at) pair, only waits on the verifier when the pool ran dry."""
+        while True:
+            with self.lock:
+                self.drop_stale()
+                entry = self.nonces.popleft() if self.nonces else None
+                low = len(self.nonces) < self.low_water
+                if entry is not None:
+                    self.metrics["taken"] += 1
+                else:
+                    self.metrics["misses"] += 1
+            if low:
+                self.refill_needed.set()
+            if entry is not None:
+                return entry
+            self.refill()
+
+    # =============================================================================
+    # Refill
+    # =============================================================================
+
+    def refill(self):
+        with self.refill_lock:
+            with self.lock:
+                self.drop_stale()
+                if len(self.nonces) >= self.low_water:
+                    # Another thread refilled the pool in the meantime
+                    return
+            fetched_at = time.time()
+            nonces, lifetime = self.fetch(self.batch_size)
+            with self.lock:
+                self.max_age = lifetime * self.max_age_ratio
+                self.nonces.extend((nonce, fetched_at) for nonce in nonces)
+                self.metrics["fetched"] += len(nonces)
+                self.metrics["batches"] += 1
+
+    def refill_periodically(self):
+        # A thread left over by a stop() directly followed by start() exits as well
+        while self.running and self.thread is threading.current_thread():
+            self.refill_needed.wait(self.time_to_stale())
+            self.refill_needed.clear()
+            if not self.running:
+                break
+            try:
+                self.refill()
+            except Exception as e:
+                if self.running:
+                    print(f"Error occurred: {str(e)}")
+                    time.sleep(1)
+
+    def drop_stale(self):
+        if self.max_age is None:
+            return
+        now = time.time()
+        while self.nonces and now - self.nonces[0][1] >= self.max_age:
+            self.nonces.popleft()
+            self.metrics["stale"] += 1
+
+    def time_to_stale(self):
+        """Seconds until the oldest nonce is dropped, the pool is then refilled before it runs short."""
+        with self.lock:
+            if not self.nonces or self.max_age is None:
+                return None
+            return max(0.0, self.nonces[0][1] + self.max_age - time.time())
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics, pooled=len(self.nonces), batch_size=self.batch_size, low_water=self.low_water)
+
+    def __len__(self):
+        return len(self.nonces)
@@ -0,0 +1,977 @@
+import copy
+import datetime
+import functools
+import os
+import threading
+import bson
+from bson import ObjectId
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult
+
+# The parties only use a storage through storage[database][collection] and the pymongo collection methods
+# below, a MongoClient is the default backend. MemoryStorage is an in-process stand-in for benchmarks that
+# must not depend on a MongoDB server, and for small reference collections that are read on every query.
+
+MISSING = object()
+
+# =============================================================================
+# Backends
+# =============================================================================
+
+memory_storage = None
+memory_storage_lock = threading.Lock()
+
+def open_storage(uri=None):
+    """
+    Storage of a party that was not given one: MongoDB at uri, localhost by default, or with
+    STORAGE_BACKEND=memory the in-process storage shared by all the parties of the process.
+    """
+    global memory_storage
+    if os.getenv("STORAGE_BACKEND", "mongo") == "memory":
+        with memory_storage_lock:
+            if memory_storage is None:
+                memory_storage = MemoryStorage()
+            return memory_storage
+    if uri is None:
+        return MongoClient('localhost', 27017)
+    return MongoClient(uri)
+
+class MemoryStorage:
+    def __init__(self):
+        self.databases = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            database = self.databases.get(name)
+            if database is None:
+                database = self.databases[name] = MemoryDatabase(self, name)
+            return database
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name):
+        return self[name]
+
+    def list_database_names(self):
+        return [name for name, database in self.databases.items() if database.list_collection_names()]
+
+    def drop_database(self, name):
+        for collection_name in self[name].list_collection_names():
+            self[name].drop_collection(collection_name)
+
+    def close(self):
+        pass
+
+class MemoryDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self.lock:
+            collection = self.collections.get(name)
+            if collection is None:
+                collection = self.collections[name] = MemoryCollection(self, name)
+            return collection
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name):
+        return self[name]
+
+    def list_collection_names(self):
+        return [name for name, collection in self.collections.items() if collection.exists]
+
+    def drop_collection(self, name):
+        self[name].drop()
+
+    def with_options(self, **options):
+        return self
+
+class MemoryCursor:
+    """The results of find and aggregate, already computed."""
+    def __init__(self, documents):
+        self.documents = documents
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.documents):
+            raise StopIteration
+        self.position += 1
+        return self.documents[self.position - 1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def sort(self, key_or_list, direction=1):
+        keys = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        self.documents = sort_documents(self.documents, keys)
+        return self
+
+    def skip(self, count):
+        self.documents = self.documents[count:]
+        return self
+
+    def limit(self, count):
+        if count:
+            self.documents = self.documents[:count]
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def close(self):
+        self.documents = []
+        self.position = 0
+
+class MemoryCollection:
+    """
+    Documents of a collection stored by column: every top level field is a list with one value per row,
+    MISSING where the document has no such field, and the field order of every row is kept apart. Reading
+    a few fields only touches their columns, and $group stages at the start of a pipeline run directly on
+    them. Equality lookups on a top level field go through a hash index built on the first lookup.
+    Returned documents are copies, except for their immutable values.
+    """
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = f"{database.name}.{name}"
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        self.columns = {}
+        self.shapes = []
+        self.shape_cache = {}
+        self.indexes = {}
+        self.unindexable = set()
+        self.unique_fields = {"_id"}
+        self.index_specs = {"_id_": {"key": [("_id", 1)]}}
+        self.exists = False
+
+    def with_options(self, **options):
+        return self
+
+    # =============================================================================
+    # Rows
+    # =============================================================================
+
+    def row(self, position, fields=None):
+        columns = self.columns
+        return {field: columns[field][position] for field in self.shapes[position] if fields is None or field in fields}
+
+    def append_row(self, document):
+        position = len(self.shapes)
+        shape = tuple(document)
+        # Documents of a collection mostly share the same fields, their shape is stored once
+        shape = self.shape_cache.setdefault(shape, shape)
+        for field in shape:
+            if field not in self.columns:
+                self.columns[field] = [MISSING] * position
+        for field, column in self.columns.items():
+            column.append(document.get(field, MISSING))
+        self.shapes.append(shape)
+        for field, index in list(self.indexes.items()):
+            value = document.get(field, MISSING)
+            if is_indexable(value):
+                index.setdefault(value, []).append(position)
+            else:
+                del self.indexes[field]
+                self.unindexable.add(field)
+        return position
+
+    def write_row(self, position, document):
+        shape = tuple(document)
+        self.shapes[position] = self.shape_cache.setdefault(shape, shape)
+        for field in shape:
+            if field not in self.columns:
+                self.columns[field] = [MISSING] * len(self.shapes)
+        for field, column in self.columns.items():
+            column[position] = document.get(field, MISSING)
+        self.drop_indexes()
+
+    def remove_rows(self, positions):
+        removed = set(positions)
+        kept = [position for position in range(len(self.shapes)) if position not in removed]
+        self.columns = {field: [column[position] for position in kept] for field, column in self.columns.items()}
+        self.shapes = [self.shapes[position] for position in kept]
+        self.drop_indexes()
+
+    def drop_indexes(self):
+        self.indexes = {}
+        self.unindexable = set()
+
+    def index(self, field):
+        """Hash index of a top level field, None when one of its values can not be hashed, a list for instance."""
+        if field in self.unindexable:
+            return None
+        index = self.indexes.get(field)
+        if index is None:
+            index = {}
+            for position, value in enumerate(self.columns.get(field, ())):
+                if not is_indexable(value):
+                    self.unindexable.add(field)
+                    return None
+                index.setdefault(value, []).append(position)
+            self.indexes[field] = index
+        return index
+
+    def candidates(self, query):
+        """Rows that may match the query, narrowed down by the index of a top level equality when there is one."""
+        for field, condition in (query or {}).items():
+            if "." in field or field.startswith("$"):
+                continue
+            if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+                if set(condition) != {"$eq"}:
+                    continue
+                condition = condition["$eq"]
+            if not is_indexable(condition) or condition is None:
+                continue
+            index = self.index(field)
+            if index is not None:
+                return index.get(condition, [])
+        return range(len(self.shapes))
+
+    def matching_positions(self, query, limit=0):
+        positions = []
+        for position in self.candidates(query):
+            if not query or matches(self.row(position), query):
+                positions.append(position)
+                if limit and len(positions) >= limit:
+                    break
+        return positions
+
+    # =============================================================================
+    # Reads
+    # =============================================================================
+
+    def find(self, filter=None, projection=None, sort=None, skip=0, limit=0, batch_size=None, **options):
+        tree = projection_tree(projection)
+        with self.lock:
+            fields = None
+            if tree is not None and tree[0] == "include" and not any(field.startswith("$") for field in filter or {}):
+                # Only the columns of the projected and of the queried fields are read
+                fields = set(tree[1]) | {field.split(".")[0] for field in filter or {}}
+                if tree[2]:
+                    fields.add("_id")
+            documents = []
+            for position in self.candidates(filter):
+                document = self.row(position, fields)
+                if not filter or matches(document, filter):
+                    documents.append(document)
+        if sort:
+            documents = sort_documents(documents, [(sort, 1)] if isinstance(sort, str) else list(sort))
+        if skip:
+            documents = documents[skip:]
+        if limit:
+            documents = documents[:limit]
+        return MemoryCursor([apply_projection(document, tree) for document in documents])
+
+    def find_one(self, filter=None, projection=None, *args, **options):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        for document in self.find(filter, projection, limit=1, **options):
+            return document
+        return None
+
+    def count_documents(self, filter=None, **options):
+        with self.lock:
+            return len(self.matching_positions(filter))
+
+    def estimated_document_count(self, **options):
+        return len(self.shapes)
+
+    def distinct(self, key, filter=None):
+        values = []
+        for document in self.find(filter):
+            for value in query_values(document, key.split(".")):
+                if value is not MISSING and not any(equal(value, seen) for seen in values):
+                    values.append(value)
+        return values
+
+    def aggregate(self, pipeline, batchSize=None, **options):
+        pipeline = list(pipeline)
+        with self.lock:
+            if pipeline and "$group" in pipeline[0] and groups_on_columns(pipeline[0]["$group"]):
+                documents = self.group_columns(pipeline.pop(0)["$group"])
+            elif pipeline and "$match" in pipeline[0]:
+                query = pipeline.pop(0)["$match"]
+                documents = [self.row(position) for position in self.matching_positions(query)]
+            else:
+                documents = [self.row(position) for position in range(len(self.shapes))]
+        return MemoryCursor(run_stages(self, documents, pipeline))
+
+    def group_columns(self, spec):
+        """$group with a constant _id whose accumulators read top level fields, computed on the columns."""
+        result = {"_id": evaluate(spec["_id"], {}, {})}
+        for name, accumulator in spec.items():
+            if name == "_id":
+                continue
+            (operator, argument), = accumulator.items()
+            if isinstance(argument, str) and argument.startswith("$"):
+                values = [value for value in self.columns.get(argument[1:], ()) if value is not MISSING]
+            else:
+                values = [argument] * len(self.shapes)
+            result[name] = ACCUMULATORS[operator](values)
+        return [result] if self.shapes else []
+
+    # =============================================================================
+    # Writes
+    # =============================================================================
+
+    def insert_one(self, document, **options):
+        with self.lock:
+            self.insert(document)
+        return InsertOneResult(document["_id"], True)
+
+    def insert_many(self, documents, ordered=True, **options):
+        inserted = []
+        errors = []
+        with self.lock:
+            for document in documents:
+                try:
+                    self.insert(document)
+                    inserted.append(document["_id"])
+                except DuplicateKeyError as e:
+                    if ordered:
+                        raise
+                    errors.append(e)
+        if errors:
+            raise errors[0]
+        return InsertManyResult(inserted, True)
+
+    def insert(self, document):
+        if hasattr(document, "raw"):
+            # RawBSONDocument, as sent by dataset_snapshot.py
+            document = bson.decode(document.raw)
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        stored = {"_id": document["_id"]}
+        stored.update((field, copy.deepcopy(value)) for field, value in document.items() if field != "_id")
+        for field in self.unique_fields:
+            value = stored.get(field, MISSING)
+            index = self.index(field)
+            if value is not MISSING and index is not None and index.get(value):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: {field}_1 dup key: {{ {field}: {value!r} }}")
+        self.exists = True
+        self.append_row(stored)
+
+    def replace_one(self, filter, replacement, upsert=False, **options):
+        with self.lock:
+            positions = self.matching_positions(filter, limit=1)
+            if positions:
+                position = positions[0]
+                document = {"_id": self.columns["_id"][position]}
+                document.update(copy.deepcopy(replacement))
+                self.write_row(position, document)
+                return UpdateResult({"n": 1, "nModified": 1, "updatedExisting": True}, True)
+            if not upsert:
+                return UpdateResult({"n": 0, "nModified": 0, "updatedExisting": False}, True)
+            document = dict(replacement)
+            if "_id" in filter and "_id" not in document:
+                document["_id"] = filter["_id"]
+            self.insert(document)
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": document["_id"], "updatedExisting": False}, True)
+
+    def update_one(self, filter, update, upsert=False, **options):
+        with self.lock:
+            return self.update(filter, update, upsert, multi=False)[0]
+
+    def update_many(self, filter, update, upsert=False, **options):
+        with self.lock:
+            return self.update(filter, update, upsert, multi=True)[0]
+
+    def find_one_and_update(self, filter, update, projection=None, upsert=False, return_document=ReturnDocument.BEFORE, **options):
+        with self.lock:
+            result, before, after = self.update(filter, update, upsert, multi=False)
+        document = after if return_document == ReturnDocument.AFTER else before
+        return apply_projection(document, projection_tree(projection)) if document is not None else None
+
+    def update(self, filter, update, upsert, multi):
+        """Returns the UpdateResult and the first updated document before and after the update."""
+        positions = self.matching_positions(filter, limit=0 if multi else 1)
+        before = after = None
+        for position in positions:
+            document = detach(self.row(position))
+            if before is None:
+                before = detach(document)
+            apply_update(document, update)
+            if after is None:
+                after = detach(document)
+            self.write_row(position, document)
+        if positions or not upsert:
+            return UpdateResult({"n": len(positions), "nModified": len(positions), "updatedExisting": bool(positions)}, True), before, after
+        document = {field: value for field, value in filter.items() if not field.startswith("$") and not (isinstance(value, dict) and any(key.startswith("$") for key in value))}
+        apply_update(document, update, inserting=True)
+        self.insert(document)
+        return UpdateResult({"n": 1, "nModified": 0, "upserted": document["_id"], "updatedExisting": False}, True), None, detach(document)
+
+    def delete_one(self, filter, **options):
+        with self.lock:
+            positions = self.matching_positions(filter, limit=1)
+            self.remove_rows(positions)
+        return DeleteResult({"n": len(positions)}, True)
+
+    def delete_many(self, filter, **options):
+        with self.lock:
+            positions = self.matching_positions(filter)
+            self.remove_rows(positions)
+        return DeleteResult({"n": len(positions)}, True)
+
+    def drop(self, **options):
+        with self.lock:
+            self.reset()
+
+    def create_index(self, keys, name=None, unique=False, **options):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = [tuple(key) for key in keys]
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        with self.lock:
+            if unique and len(keys) == 1 and "." not in keys[0][0]:
+                field = keys[0][0]
+                index = self.index(field)
+                if index is not None and any(len(positions) > 1 for value, positions in index.items() if value is not MISSING):
+                    raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.full_name} index: {name}")
+                self.unique_fields.add(field)
+            self.index_specs[name] = dict({"key": keys}, **({"unique": True} if unique else {}), **{option: value for option, value in options.items() if option == "sparse"})
+            self.exists = True
+        return name
+
+    def index_information(self):
+        return copy.deepcopy(self.index_specs)
+
+    def watch(self, *args, **kwargs):
+        # Like a standalone server, the change feeds of the parties then poll the version counters
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+# =============================================================================
+# Values
+# =============================================================================
+
+def is_indexable(value):
+    return value is MISSING or isinstance(value, (str, int, float, bool, ObjectId, datetime.datetime, type(None)))
+
+def detach(value):
+    """Copy of the mutable parts of a value, so that callers can not modify the stored documents."""
+    if isinstance(value, dict):
+        return {key: detach(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [detach(item) for item in value]
+    return value
+
+def type_order(value):
+    # Order of the BSON types in comparisons and sorts
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, (bytes, bytearray)):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+def compare(left, right):
+    left_order, right_order = type_order(left), type_order(right)
+    if left_order != right_order:
+        return -1 if left_order < right_order else 1
+    if left_order == 1:
+        return 0
+    if left_order in (4, 5):
+        left, right = repr(left), repr(right)
+    return (left > right) - (left < right)
+
+def equal(left, right):
+    return compare(left, right) == 0 if type_order(left) == type_order(right) else False
+
+def resolve(value, path):
+    """Value of a dotted path in expressions, a path through an array gives the array of the values found."""
+    for key in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(key, MISSING)
+        elif isinstance(value, list):
+            value = [item for item in (resolve(element, key) for element in value if isinstance(element, dict)) if item is not MISSING]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+def set_path(document, path, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.setdefault(key, {})
+    document[keys[-1]] = value
+
+def set_copied_path(document, path, value):
+    """
+    set_path on a shallow copy of a stored row, the dicts along the path are copied first so that the
+    write does not reach the nested dicts of the stored document.
+    """
+    keys = path.split(".")
+    for key in keys[:-1]:
+        nested = document.get(key)
+        document[key] = dict(nested) if isinstance(nested, dict) else {}
+        document = document[key]
+    document[keys[-1]] = value
+
+def unset_path(document, path):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.get(key)
+        if not isinstance(document, dict):
+            return
+    document.pop(keys[-1], None)
+
+def sort_documents(documents, keys):
+    def order(left, right):
+        for path, direction in keys:
+            result = compare(resolve(left, path), resolve(right, path))
+            if result:
+                return result * (1 if direction >= 0 else -1)
+        return 0
+    return sorted(documents, key=functools.cmp_to_key(order))
+
+# =============================================================================
+# Queries
+# =============================================================================
+
+def query_values(value, keys):
+    """Values a query on a dotted path compares with, an array matches through any of its elements."""
+    if not keys:
+        return [value] + (value if isinstance(value, list) else [])
+    if isinstance(value, dict):
+        return query_values(value[keys[0]], keys[1:]) if keys[0] in value else [MISSING]
+    if isinstance(value, list):
+        found = [item for element in value if isinstance(element, dict) for item in query_values(element, keys) if item is not MISSING]
+        return found or [MISSING]
+    return [MISSING]
+
+def matches(document, query):
+    for field, condition in query.items():
+        if field == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif field == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif field == "$nor":
+            if any(matches(document, part) for part in condition):
+                return False
+        elif not condition_matches(query_values(document, field.split(".")), condition):
+            return False
+    return True
+
+def condition_matches(values, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        return all(operator_matches(values, operator, argument) for operator, argument in condition.items())
+    return any(equal(None if value is MISSING else value, condition) for value in values)
+
+def operator_matches(values, operator, argument):
+    present = [value for value in values if value is not MISSING]
+    if operator == "$eq":
+        return condition_matches(values, {"$in": [argument]})
+    if operator == "$ne":
+        return not condition_matches(values, {"$in": [argument]})
+    if operator == "$in":
+        return any(equal(None if value is MISSING else value, candidate) for value in values for candidate in argument)
+    if operator == "$nin":
+        return not operator_matches(values, "$in", argument)
+    if operator == "$exists":
+        return bool(present) == bool(argument)
+    if operator in COMPARISONS:
+        # Unlike sorts, query comparisons only match values of the same type
+        return any(type_order(value) == type_order(argument) and COMPARISONS[operator](compare(value, argument)) for value in present)
+    raise ValueError(f"Unsupported query operator {operator}")
+
+COMPARISONS = {
+    "$gt": lambda result: result > 0,
+    "$gte": lambda result: result >= 0,
+    "$lt": lambda result: result < 0,
+    "$lte": lambda result: result <= 0,
+}
+
+def projection_tree(projection):
+    """("include" or "exclude", nested dict of the projected paths, whether _id is kept), None without projection."""
+    if not projection:
+        return None
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    keep_id = bool(projection.get("_id", 1))
+    fields = {field: value for field, value in projection.items() if field != "_id"}
+    mode = "include" if any(fields.values()) or (not fields and keep_id) else "exclude"
+    tree = {}
+    for path in fields:
+        node = tree
+        keys = path.split(".")
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+            if node is True:
+                break
+        else:
+            node[keys[-1]] = True
+    return mode, tree, keep_id
+
+def apply_projection(document, tree):
+    if tree is None:
+        return detach(document)
+    mode, paths, keep_id = tree
+    if mode == "include":
+        result = {"_id": document["_id"]} if keep_id and "_id" in document else {}
+        result.update(include_paths(document, paths))
+        return result
+    result = exclude_paths(document, paths)
+    if not keep_id:
+        result.pop("_id", None)
+    return result
+
+def include_paths(document, paths):
+    result = {}
+    for field, value in document.items():
+        node = paths.get(field)
+        if node is True:
+            result[field] = detach(value)
+        elif node is not None:
+            if isinstance(value, dict):
+                result[field] = include_paths(value, node)
+            elif isinstance(value, list):
+                result[field] = [include_paths(element, node) for element in value if isinstance(element, dict)]
+    return result
+
+def exclude_paths(document, paths):
+    result = {}
+    for field, value in document.items():
+        node = paths.get(field)
+        if node is True:
+            continue
+        if node is not None and isinstance(value, dict):
+            result[field] = exclude_paths(value, node)
+        elif node is not None and isinstance(value, list):
+            result[field] = [exclude_paths(element, node) if isinstance(element, dict) else detach(element) for element in value]
+        else:
+            result[field] = detach(value)
+    return result
+
+def apply_update(document, update, inserting=False):
+    if not any(key.startswith("$") for key in update):
+        raise ValueError("update only works with $ operators, use replace_one")
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == "$set" or (operator == "$setOnInsert" and inserting):
+                set_path(document, path, copy.deepcopy(value))
+            elif operator == "$unset":
+                unset_path(document, path)
+            elif operator == "$inc":
+                current = resolve(document, path)
+                set_path(document, path, (0 if current is MISSING else current) + value)
+            elif operator == "$push":
+                current = resolve(document, path)
+                set_path(document, path, ([] if current is MISSING else current) + [copy.deepcopy(value)])
+            elif operator != "$setOnInsert":
+                raise ValueError(f"Unsupported update operator {operator}")
+
+# =============================================================================
+# Aggregation expressions
+# =============================================================================
+
+def evaluate(expression, document, variables):
+    if isinstance(expression, str):
+        if expression.startswith("$$"):
+            name, _, path = expression[2:].partition(".")
+            if name == "ROOT" or name == "CURRENT":
+                value = document
+            elif name in variables:
+                value = variables[name]
+            else:
+                raise ValueError(f"Undefined variable {name}")
+            return resolve(value, path) if path else value
+        if expression.startswith("$"):
+            return resolve(document, expression[1:])
+        return expression
+    if isinstance(expression, list):
+        return [value_of(evaluate(item, document, variables)) for item in expression]
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            (operator, argument), = expression.items()
+            if operator.startswith("$"):
+                if operator not in OPERATORS:
+                    raise ValueError(f"Unsupported aggregation operator {operator}")
+                return OPERATORS[operator](argument, document, variables)
+        return {key: value_of(evaluate(value, document, variables)) for key, value in expression.items()}
+    return expression
+
+def value_of(value):
+    return None if value is MISSING else value
+
+def truthy(value):
+    return value not in (None, False, MISSING) and not (isinstance(value, (int, float)) and not isinstance(value, bool) and value == 0)
+
+def arguments(argument, document, variables):
+    if not isinstance(argument, list):
+        argument = [argument]
+    return [value_of(evaluate(item, document, variables)) for item in argument]
+
+def comparison(test):
+    def operator(argument, document, variables):
+        left, right = arguments(argument, document, variables)
+        return test(compare(left, right))
+    return operator
+
+def operator_cond(argument, document, variables):
+    if isinstance(argument, dict):
+        condition, then, otherwise = argument["if"], argument["then"], argument["else"]
+    else:
+        condition, then, otherwise = argument
+    return evaluate(then if truthy(evaluate(condition, document, variables)) else otherwise, document, variables)
+
+def operator_filter(argument, document, variables):
+    items = value_of(evaluate(argument["input"], document, variables))
+    if items is None:
+        return None
+    name = argument.get("as", "this")
+    return [item for item in items if truthy(evaluate(argument["cond"], document, dict(variables, **{name: item})))]
+
+def operator_let(argument, document, variables):
+    bound = dict(variables)
+    for name, expression in argument["vars"].items():
+        bound[name] = value_of(evaluate(expression, document, variables))
+    return evaluate(argument["in"], document, bound)
+
+def operator_in(argument, document, variables):
+    value, items = arguments(argument, document, variables)
+    if not isinstance(items, list):
+        raise ValueError("$in needs an array")
+    return any(equal(value, item) for item in items)
+
+def operator_size(argument, document, variables):
+    items, = arguments(argument, document, variables)
+    if not isinstance(items, list):
+        raise ValueError("The argument to $size must be an array")
+    return len(items)
+
+def operator_if_null(argument, document, variables):
+    for value in arguments(argument, document, variables):
+        if value is not None:
+            return value
+    return None
+
+def arithmetic(combine):
+    def operator(argument, document, variables):
+        values = arguments(argument, document, variables)
+        if any(value is None for value in values):
+            return None
+        return functools.reduce(combine, values)
+    return operator
+
+OPERATORS = {
+    "$eq": comparison(lambda result: result == 0),
+    "$ne": comparison(lambda result: result != 0),
+    "$gt": comparison(lambda result: result > 0),
+    "$gte": comparison(lambda result: result >= 0),
+    "$lt": comparison(lambda result: result < 0),
+    "$lte": comparison(lambda result: result <= 0),
+    "$and": lambda argument, document, variables: all(truthy(evaluate(item, document, variables)) for item in argument),
+    "$or": lambda argument, document, variables: any(truthy(evaluate(item, document, variables)) for item in argument),
+    "$not": lambda argument, document, variables: not truthy(arguments(argument, document, variables)[0]),
+    "$cond": operator_cond,
+    "$filter": operator_filter,
+    "$let": operator_let,
+    "$in": operator_in,
+    "$size": operator_size,
+    "$ifNull": operator_if_null,
+    "$literal": lambda argument, document, variables: argument,
+    "$add": arithmetic(lambda left, right: left + right),
+    "$subtract": arithmetic(lambda left, right: left - right),
+    "$multiply": arithmetic(lambda left, right: left * right),
+    "$divide": arithmetic(lambda left, right: left / right),
+}
+
+# =============================================================================
+# Aggregation stages
+# =============================================================================
+
+def accumulate_avg(values):
+    numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+    return sum(numbers) / len(numbers) if numbers else None
+
+ACCUMULATORS = {
+    "$avg": accumulate_avg,
+    "$sum": lambda values: sum(value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)),
+    "$min": lambda values: min((value for value in values if value is not None), key=functools.cmp_to_key(compare), default=None),
+    "$max": lambda values: max((value for value in values if value is not None), key=functools.cmp_to_key(compare), default=None),
+    "$first": lambda values: values[0] if values else None,
+    "$last": lambda values: values[-1] if values else None,
+    "$push": list,
+}
+
+def groups_on_columns(spec):
+    if not is_indexable(spec.get("_id")) or (isinstance(spec.get("_id"), str) and spec["_id"].startswith("$")):
+        return False
+    for name, accumulator in spec.items():
+        if name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            return False
+        (operator, argument), = accumulator.items()
+        if operator not in ACCUMULATORS or operator in ("$first", "$last", "$push"):
+            return False
+        if isinstance(argument, str) and argument.startswith("$") and ("." in argument or argument.startswith("$$")):
+            return False
+        if isinstance(argument, (dict, list)):
+            return False
+    return True
+
+def stage_match(collection, documents, spec, variables):
+    return [document for document in documents if matches(document, spec)]
+
+def stage_add_fields(collection, documents, spec, variables):
+    result = []
+    for document in documents:
+        extended = dict(document)
+        for path, expression in spec.items():
+            value = evaluate(expression, document, variables)
+            if value is not MISSING:
+                set_copied_path(extended, path, value)
+        result.append(extended)
+    return result
+
+def stage_project(collection, documents, spec, variables):
+    keep_id = spec.get("_id", 1)
+    fields = {path: expression for path, expression in spec.items() if path != "_id"}
+    exclusion = bool(fields) and all(expression in (0, False) for expression in fields.values())
+    result = []
+    for document in documents:
+        if exclusion:
+            projected = apply_projection(document, projection_tree(spec))
+        else:
+            projected = {}
+            if keep_id in (1, True) and "_id" in document:
+                projected["_id"] = document["_id"]
+            elif keep_id not in (0, False, 1, True):
+                projected["_id"] = value_of(evaluate(keep_id, document, variables))
+            included = {path: True for path, expression in fields.items() if expression in (1, True)}
+            if included:
+                projected.update(include_paths(document, projection_tree(included)[1]))
+            for path, expression in fields.items():
+                if expression not in (1, True, 0, False):
+                    value = evaluate(expression, document, variables)
+                    if value is not MISSING:
+                        set_path(projected, path, value)
+        result.append(projected)
+    return result
+
+def stage_lookup(collection, documents, spec, variables):
+    foreign = collection.database[spec["from"]]
+    local_keys = spec["localField"].split(".")
+    foreign_field = spec["foreignField"]
+    result = []
+    with foreign.lock:
+        # The hash index of a top level foreign field, the _id of the access controls for instance
+        index = foreign.index(foreign_field) if "." not in foreign_field else None
+        if index is None:
+            index = {}
+            for position in range(len(foreign.shapes)):
+                for value in query_values(foreign.row(position), foreign_field.split(".")):
+                    value = value_of(value)
+                    if is_indexable(value):
+                        index.setdefault(value, []).append(position)
+        for document in documents:
+            positions = set()
+            for value in query_values(document, local_keys):
+                value = value_of(value)
+                if is_indexable(value):
+                    positions.update(index.get(value, ()))
+            joined = dict(document)
+            joined[spec["as"]] = [foreign.row(position) for position in sorted(positions)]
+            result.append(joined)
+    return result
+
+def stage_group(collection, documents, spec, variables):
+    groups = {}
+    for document in documents:
+        key = value_of(evaluate(spec["_id"], document, variables))
+        group = groups.setdefault(repr(key), (key, {name: [] for name in spec if name != "_id"}))
+        for name, accumulator in spec.items():
+            if name == "_id":
+                continue
+            (operator, argument), = accumulator.items()
+            group[1][name].append(value_of(evaluate(argument, document, variables)))
+    result = []
+    for key, values in groups.values():
+        grouped = {"_id": key}
+        for name, accumulator in spec.items():
+            if name != "_id":
+                grouped[name] = ACCUMULATORS[next(iter(accumulator))](values[name])
+        result.append(grouped)
+    return result
+
+def stage_unwind(collection, documents, spec, variables):
+    path = (spec if isinstance(spec, str) else spec["path"])[1:]
+    keep_empty = isinstance(spec, dict) and spec.get("preserveNullAndEmptyArrays", False)
+    result = []
+    for document in documents:
+        items = resolve(document, path)
+        if isinstance(items, list) and items:
+            for item in items:
+                unwound = dict(document)
+                set_copied_path(unwound, path, item)
+                result.append(unwound)
+        elif keep_empty or (items is not MISSING and items is not None and not isinstance(items, list)):
+            result.append(document)
+    return result
+
+STAGES = {
+    "$match": stage_match,
+    "$addFields": stage_add_fields,
+    "$set": stage_add_fields,
+    "$project": stage_project,
+    "$lookup": stage_lookup,
+    "$group": stage_group,
+    "$unwind": stage_unwind,
+    "$sort": lambda collection, documents, spec, variables: sort_documents(documents, list(spec.items())),
+    "$skip": lambda collection, documents, spec, variables: documents[spec:],
+    "$limit": lambda collection, documents, spec, variables: documents[:spec],
+    "$count": lambda collection, documents, spec, variables: [{spec: len(documents)}] if documents else [],
+}
+
+def run_stages(collection, documents, pipeline):
+    """
+    Runs the stages of pipeline on documents and returns copies of the output documents. Only $lookup
+    reads collection, for the other collections of its database, a caller that runs the stages on
+    documents of its own may pass None when the pipeline has no $lookup.
+    """
+    variables = {"NOW": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)}
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name not in STAGES:
+            raise ValueError(f"Unsupported aggregation stage {name}")
+        documents = STAGES[name](collection, documents, spec, variables)
+    return [detach(document) for document in documents]
@@ -0,0 +1,154 @@
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+class NoSpan:
+    """Returned while tracing is disabled, entering and leaving it does nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NO_SPAN = NoSpan()
+
+class Span:
+    __slots__ = ("tracer", "trace_id", "party", "name", "start")
+
+    def __init__(self, tracer, trace_id, party, name):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.party = party
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.trace_id, self.party, self.name, self.start, time.monotonic_ns(), exc_type is not None)
+        return False
+
+class Tracer:
+    """
+    Named spans timed on the monotonic clock, which all the processes of a host share. The trace id of the
+    query being served is kept in a context variable, TLSHelper adds it to the messages it sends and a
+    server adopts the one of the request it receives, so the spans of every party a query goes through
+    carry the id the client started. The last capacity spans stay in a ring buffer, with a path they are
+    also written as JSON lines by a background thread.
+    Disabled, span() returns a shared object that does nothing and no message carries a trace id.
+    """
+    def __init__(self, capacity=100000, flush_interval=0.1):
+        self.enabled = False
+        self.flush_interval = flush_interval
+        self.spans = deque(maxlen=capacity)
+        # deque.append and popleft are atomic, the traced threads never wait for the writer
+        self.pending = deque()
+        self.trace_id = contextvars.ContextVar("trace_id", default=None)
+        self.file = None
+        self.write_lock = threading.Lock()
+        self.thread = None
+
+    def enable(self, path=None, capacity=None):
+        if capacity is not None and capacity != self.spans.maxlen:
+            self.spans = deque(self.spans, maxlen=capacity)
+        if path is not None and self.file is None:
+            self.file = open(path, "a")
+            self.thread = threading.Thread(target=self.write_periodically, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    # =============================================================================
+    # Context
+    # =============================================================================
+
+    def start_trace(self):
+        """Gives the calling thread, or task, a new trace id, called by the client for every query."""
+        if not self.enabled:
+            return None
+        trace_id = uuid.uuid4().hex
+        self.trace_id.set(trace_id)
+        return trace_id
+
+    def get_trace_id(self):
+        return self.trace_id.get()
+
+    def set_trace_id(self, trace_id):
+        self.trace_id.set(trace_id)
+
+    def span(self, party, name):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, self.trace_id.get(), party, name)
+
+    def record(self, trace_id, party, name, start, end, failed=False):
+        span = {"trace_id": trace_id, "party": party, "span": name, "start_ns": start, "duration_ns": end - start}
+        if failed:
+            span["failed"] = True
+        self.spans.append(span)
+        if self.file is not None:
+            self.pending.append(span)
+
+    def get_spans(self, trace_id=None):
+        spans = list(self.spans)
+        if trace_id is None:
+            return spans
+        return [span for span in spans if span["trace_id"] == trace_id]
+
+    def get_metrics(self):
+        """Count and mean duration in milliseconds of every party and span name in the ring buffer."""
+        totals = {}
+        for span in list(self.spans):
+            key = f"{span['party']}.{span['span']}"
+            count, total = totals.get(key, (0, 0))
+            totals[key] = (count + 1, total + span["duration_ns"])
+        return {key: {"count": count, "mean_ms": total / count / 1e6} for key, (count, total) in totals.items()}
+
+    # =============================================================================
+    # Writer
+    # =============================================================================
+
+    def write_periodically(self):
+        while self.file is not None:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error occurred: {str(e)}")
+
+    def flush(self):
+        with self.write_lock:
+            if self.file is None:
+                return
+            lines = []
+            while self.pending:
+                lines.append(json.dumps(self.pending.popleft(), separators=(",", ":")) + "\n")
+            if lines:
+                self.file.write("".join(lines))
+                self.file.flush()
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# Shared by all the parties of a process. TRACE_SPANS=1 keeps the spans in the ring buffer only,
+# TRACE_FILE=<path> also writes them to the file.
+tracer = Tracer()
+if os.getenv("TRACE_FILE"):
+    tracer.enable(os.getenv("TRACE_FILE"))
+elif os.getenv("TRACE_SPANS"):
+    tracer.enable()
@@ -0,0 +1,234 @@
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from populate_db import VERSIONS_COLLECTION, bump_versions, connect
+
+# Snapshots of the test dataset on disk, so that every benchmark starts from the same documents without
+# running populate_db.py again. A snapshot is a directory with a manifest.json and, per collection, gzip
+# shards of concatenated BSON documents (or canonical extended JSON lines with --format ndjson).
+# The manifest lists the shards with their document count and sha256 and the indexes of every collection,
+# its dataset_id hashes all the shards so that two runs can tell whether they used the same data.
+# Usage: python dataset_snapshot.py export <directory> [--label seed42-scale0.1]
+#        python dataset_snapshot.py load <directory> [--database test_dataset]
+
+FORMAT_VERSION = 1
+EXTENSIONS = {"bson": ".bson.gz", "ndjson": ".ndjson.gz"}
+
+# =============================================================================
+# Shards
+# =============================================================================
+
+def encode_documents(raw_documents, data_format):
+    if data_format == "bson":
+        return b"".join(raw_documents)
+    lines = (json_util.dumps(bson.decode(raw), json_options=json_util.CANONICAL_JSON_OPTIONS) for raw in raw_documents)
+    return "".join(line + "\n" for line in lines).encode()
+
+def decode_documents(payload, data_format, raw=True):
+    """
+    With raw, documents of BSON shards are RawBSONDocuments that pymongo inserts without decoding
+    and encoding them again. Stand-ins get dicts.
+    """
+    if data_format == "bson":
+        position = 0
+        while position < len(payload):
+            size = int.from_bytes(payload[position:position + 4], "little")
+            document = payload[position:position + size]
+            yield RawBSONDocument(document) if raw else bson.decode(document)
+            position += size
+    else:
+        for line in payload.splitlines():
+            if line:
+                yield json_util.loads(line)
+
+def write_shard(task):
+    """Compresses the documents of one shard to disk, returns its manifest entry."""
+    path, raw_documents, data_format, compression_level = task
+    payload = encode_documents(raw_documents, data_format)
+    compressed = gzip.compress(payload, compresslevel=compression_level, mtime=0)
+    with open(path, "wb") as file:
+        file.write(compressed)
+    return {"file": os.path.basename(path), "documents": len(raw_documents), "sha256": hashlib.sha256(compressed).hexdigest()}
+
+def read_shard(path, expected_sha256=None):
+    with open(path, "rb") as file:
+        compressed = file.read()
+    if expected_sha256 is not None and hashlib.sha256(compressed).hexdigest() != expected_sha256:
+        raise ValueError(f"Corrupted shard {path}")
+    return gzip.decompress(compressed)
+
+# =============================================================================
+# Export
+# =============================================================================
+
+def export_snapshot(database, directory, pool, data_format="bson", shard_size=50000, compression_level=6, label=None, created=None):
+    """
+    Writes every collection of the database in _id order, the shards are compressed by the pool. Two
+    exports of the same documents with the same arguments write the same bytes, the manifest only records
+    a creation time when one is given.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "format": data_format,
+        "database": database.name,
+        "label": label,
+        "created": created,
+        "collections": {},
+    }
+    raw_collections = database.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    for collection_name in sorted(database.list_collection_names()):
+        if collection_name == VERSIONS_COLLECTION:
+            # Counters of the running parties, not data
+            continue
+        started = time.monotonic()
+        pending = []
+        shard = []
+
+        def submit(shard):
+            path = os.path.join(directory, f"{collection_name}.{len(pending):05d}{EXTENSIONS[data_format]}")
+            pending.append(pool.apply_async(write_shard, ((path, shard, data_format, compression_level),)))
+
+        for document in raw_collections[collection_name].find({}, sort=[("_id", 1)], batch_size=10000):
+            # Plain dicts from the in memory storage, which ignores the codec options
+            shard.append(document.raw if isinstance(document, RawBSONDocument) else bson.encode(document))
+            if len(shard) >= shard_size:
+                submit(shard)
+                shard = []
+        if shard or not pending:
+            submit(shard)
+        shards = [result.get() for result in pending]
+        indexes = [
+            {"key": list(index["key"]), "name": name, **{option: index[option] for option in ("unique", "sparse") if option in index}}
+            for name, index in database[collection_name].index_information().items() if name != "_id_"
+        ]
+        manifest["collections"][collection_name] = {"shards": shards, "indexes": indexes}
+        documents = sum(entry["documents"] for entry in shards)
+        print(f"Exported {collection_name}: {documents} documents in {len(shards)} shards, {time.monotonic() - started:.1f}s")
+    dataset_hash = hashlib.sha256()
+    for collection_name, collection in sorted(manifest["collections"].items()):
+        for entry in collection["shards"]:
+            dataset_hash.update(f"{collection_name}/{entry['file']}/{entry['sha256']}\n".encode())
+    manifest["dataset_id"] = dataset_hash.hexdigest()
+    with open(os.path.join(directory, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=4)
+    return manifest
+
+# =============================================================================
+# Load
+# =============================================================================
+
+db = None
+
+def init_worker(database_name):
+    global db
+    db = connect()[database_name]
+
+def load_shard(task):
+    """Inserts one shard through unordered insert_many, returns the number of documents inserted."""
+    directory, collection_name, entry, data_format, batch_size = task
+    payload = read_shard(os.path.join(directory, entry["file"]), entry["sha256"])
+    return insert_documents(db[collection_name], decode_documents(payload, data_format), batch_size)
+
+def insert_documents(collection, documents, batch_size):
+    inserted = 0
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            inserted += len(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        inserted += len(batch)
+    return inserted
+
+def read_manifest(directory):
+    with open(os.path.join(directory, "manifest.json")) as file:
+        manifest = json.load(file)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format version {manifest['format_version']}")
+    return manifest
+
+def iter_documents(directory, collection_name):
+    """Documents of a collection of the snapshot, for stand-ins that are not loaded through pymongo."""
+    manifest = read_manifest(directory)
+    for entry in manifest["collections"][collection_name]["shards"]:
+        payload = read_shard(os.path.join(directory, entry["file"]), entry["sha256"])
+        yield from decode_documents(payload, manifest["format"], raw=False)
+
+def iter_shard(task):
+    directory, collection_name, entry, data_format, batch_size = task
+    payload = read_shard(os.path.join(directory, entry["file"]), entry["sha256"])
+    return decode_documents(payload, data_format, raw=False)
+
+def load_snapshot(database, directory, pool=None, batch_size=1000):
+    """
+    Replaces the collections of the database with the snapshot. The shards are inserted by the pool,
+    whose workers are connected to the same database by init_worker, or in this process without a pool,
+    which also works for a pymongo compatible stand-in. Indexes are built last.
+    """
+    manifest = read_manifest(directory)
+    data_format = manifest["format"]
+    started = time.monotonic()
+    tasks = []
+    for collection_name, collection in manifest["collections"].items():
+        # Dropping also removes the indexes, they are built once the documents are loaded
+        database[collection_name].drop()
+        tasks.extend((directory, collection_name, entry, data_format, batch_size) for entry in collection["shards"])
+    # Largest shards first so that the last ones running are short
+    tasks.sort(key=lambda task: task[2]["documents"], reverse=True)
+    if pool is None:
+        results = (insert_documents(database[task[1]], iter_shard(task), batch_size) for task in tasks)
+    else:
+        results = pool.imap_unordered(load_shard, tasks)
+    total = sum(task[2]["documents"] for task in tasks)
+    loaded = 0
+    for count in results:
+        loaded += count
+        print(f"Loaded {loaded}/{total} documents ({100 * loaded / total if total else 100:.1f}%), {loaded / (time.monotonic() - started):.0f} documents/s")
+    for collection_name, collection in manifest["collections"].items():
+        for index in collection["indexes"]:
+            options = {option: index[option] for option in ("unique", "sparse") if option in index}
+            database[collection_name].create_index([tuple(key) for key in index["key"]], name=index["name"], **options)
+    bump_versions(database, manifest["collections"])
+    print(f"Snapshot {manifest['dataset_id'][:12]} ({manifest.get('label')}) loaded in {time.monotonic() - started:.1f}s")
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the test dataset to a snapshot or loads a snapshot into it")
+    parser.add_argument("command", choices=["export", "load"])
+    parser.add_argument("directory")
+    parser.add_argument("--database", default="test_dataset")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--format", choices=list(EXTENSIONS), default="bson")
+    parser.add_argument("--shard-size", type=int, default=50000, help="documents per shard")
+    parser.add_argument("--compression-level", type=int, default=6)
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per insert_many")
+    parser.add_argument("--label", help="free text stored in the manifest, the populate_db.py seed and scale for instance")
+    parser.add_argument("--timestamp", action="store_true", help="records the creation time in the manifest, which then differs between exports")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        with multiprocessing.Pool(args.workers) as pool:
+            database = connect()[args.database]
+            created = datetime.datetime.now(datetime.timezone.utc).isoformat() if args.timestamp else None
+            manifest = export_snapshot(database, args.directory, pool, args.format, args.shard_size, args.compression_level, args.label, created)
+        print(f"Snapshot {manifest['dataset_id']} written to {args.directory}")
+    else:
+        # The workers are forked before the parent opens its own MongoClient
+        with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(args.database,)) as pool:
+            load_snapshot(connect()[args.database], args.directory, pool, args.batch_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+# Drives one of the naive, simple or extended flows with concurrent sessions and reports the latency
+# percentiles and the sustained throughput of every route. Unlike the main.py drivers the parties run in
+# their long running server modes for the whole test, each worker owns an open session and sends its
+# queries back to back (closed loop), or takes them from a schedule at a fixed rate (open loop, --rate).
+# Open loop latencies are counted from the scheduled time, so a saturated flow shows up as queueing delay
+# instead of a lower request rate. Requests started during the warmup are not reported.
+# The modules of the three flows share their names, a run loads the ones of a single flow.
+# With --storage memory the simple and extended parties share an in-process storage filled by populate_db.py
+# instead of MongoDB, the results then only depend on the CPU.
+# Usage: python load_test.py extended --concurrency 8 --duration 30 --warmup 5 [--rate 50] [--csv load.csv]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLOW_DIRECTORIES = {
+    "naive": os.path.join(ROOT, "tests", "naive"),
+    "simple": os.path.join(ROOT, "simple_data_access"),
+    "extended": os.path.join(ROOT, "extended_data_access"),
+}
+# is_bp_above_mean runs in the client TEE of the extended flow, the naive flow compares with the mean itself
+FLOW_ROUTES = {
+    "naive": ["is_bp_above_mean"],
+    "simple": ["get_bp", "get_height"],
+    "extended": ["is_bp_above_mean"],
+}
+USERS = {"get_bp": "doctor1", "get_height": "patient1", "is_bp_above_mean": "external1"}
+USER_IDS = {"doctor1": "000000000000000000000000", "patient1": "111111111111111111111111", "external1": "222222222222222222222222"}
+PATIENT_ID = "111111111111111111111111"
+
+host = "127.0.0.1"
+certs = os.path.join(ROOT, "extended_data_access", "certs")
+ca_cert_file = os.path.join(certs, "ca-cert.pem")
+server_key_file = os.path.join(certs, "server-key.pem")
+server_cert_file = os.path.join(certs, "server-cert.pem")
+
+# =============================================================================
+# Flows
+# =============================================================================
+
+class NaiveSession:
+    def __init__(self, db_port):
+        from TLS_helper import TLSHelper
+        self.connection = TLSHelper(ca_cert_file, is_server=False)
+        self.connection.connect(host, db_port)
+
+    def query(self, route):
+        from tools import generate_request
+        request = generate_request(["verb", "route", "patient_id", "user_id", "attestation"], ["GET", "test", PATIENT_ID, USER_IDS[USERS[route]], True])
+        self.connection.send(request)
+        return json.loads(self.connection.receive())
+
+    def forget_attestations(self):
+        pass
+
+    def close(self):
+        self.connection.close()
+
+class SimpleSession:
+    def __init__(self, client, tee_port, verifier_port):
+        self.client = client
+        self.client.open_session(host, tee_port, host, verifier_port)
+
+    def query(self, route):
+        from tools import generate_message_from_lists
+        query = generate_message_from_lists(["method", "route", "username", "password", "params"], ["GET", route, USERS[route], "password", {"patient_id": PATIENT_ID}])
+        return self.client.query(query)
+
+    def forget_attestations(self):
+        self.client.attestations.clear()
+
+    def close(self):
+        self.client.close_session()
+
+class ExtendedSession(SimpleSession):
+    def __init__(self, client, client_tee, client_tee_port):
+        self.client = client
+        self.client_tee = client_tee
+        self.client.open_session(host, client_tee_port)
+
+    def forget_attestations(self):
+        self.client_tee.attestations.clear()
+
+def memory_storage(args):
+    """In-process storage holding the databases the parties read, filled as populate_db.py fills MongoDB."""
+    from storage import MemoryStorage
+    from populate_db import ENTRIES, pipelines, populate
+    storage = MemoryStorage()
+    populate(storage["medical-data"], int(ENTRIES * args.scale), args.seed)
+    storage["pipelines"]["approved_pipelines"].insert_many(pipelines)
+    storage["data"]["pipelines"].insert_many(pipelines)
+    storage["data"]["bp"].insert_many(storage["medical-data"]["bps"].find({}, {"_id": 0, "bp": 1}))
+    return storage
+
+def setup_naive(args):
+    from time_evalutation import DB
+    db = DB(ca_cert_file, server_cert_file, server_key_file)
+    threading.Thread(target=db.serve, args=(host, args.base_port), daemon=True).start()
+    return [NaiveSession(args.base_port) for _ in range(args.concurrency)], db.stop
+
+def setup_simple(args):
+    from client import Client
+    from tee_db_proxy import TEE_DB_Proxy
+    from verifier import Verifier
+    verifier_port, tee_port = args.base_port, args.base_port + 1
+    storage = memory_storage(args) if args.storage == "memory" else None
+    verifier = Verifier(ca_cert_file, server_cert_file, server_key_file, storage=storage)
+    tee_db_proxy = TEE_DB_Proxy(ca_cert_file, server_cert_file, server_key_file, storage=storage)
+    verifier.set_tee_public_key(tee_db_proxy.get_public_key())
+    threading.Thread(target=verifier.serve, args=(host, verifier_port), daemon=True).start()
+    threading.Thread(target=tee_db_proxy.serve, args=(host, tee_port), daemon=True).start()
+    sessions = [SimpleSession(Client(ca_cert_file, tee_db_proxy.get_public_key(), verifier.get_public_key(), codec=args.codec), tee_port, verifier_port) for _ in range(args.concurrency)]
+
+    def stop():
+        tee_db_proxy.stop()
+        verifier.close()
+    return sessions, stop
+
+def setup_extended(args):
+    from client import Client
+    from client_tee import ClientTEE
+    from tee_db_proxy import TEE_DB_Proxy
+    from verifier import Verifier
+    verifier_port, other_verifier_port, tee_port = range(args.base_port, args.base_port + 3)
+    storage = memory_storage(args) if args.storage == "memory" else None
+    verifier = Verifier(ca_cert_file, server_cert_file, server_key_file, storage=storage)
+    tee_db_proxy = TEE_DB_Proxy(ca_cert_file, server_cert_file, server_key_file, verifier.get_public_key(), codec=args.codec, storage=storage)
+    verifier.set_tee_public_key(tee_db_proxy.get_public_key())
+    if args.async_verifier:
+        threading.Thread(target=asyncio.run, args=(verifier.serve_async(host, verifier_port, other_verifier_port),), daemon=True).start()
+    else:
+        threading.Thread(target=verifier.serve, args=(host, verifier_port, other_verifier_port), daemon=True).start()
+    threading.Thread(target=tee_db_proxy.serve, args=(host, tee_port, host, other_verifier_port), daemon=True).start()
+    # A client TEE serves a single client, every session gets its own one. The verifier knows a single
+    # client TEE public key, they all sign with the key of the first one.
+    sessions = []
+    client_tees = []
+    for i in range(args.concurrency):
+        client_tee = ClientTEE(ca_cert_file, server_cert_file, server_key_file, tee_db_proxy.get_public_key(), verifier.get_public_key(), codec=args.codec, protocol=args.protocol, storage=storage)
+        if client_tees:
+            client_tee.private_signing_key = client_tees[0].private_signing_key
+            client_tee.public_signing_key = client_tees[0].public_signing_key
+        else:
+            verifier.set_client_tee_public_key(client_tee.get_public_key())
+        client_tees.append(client_tee)
+        client_tee_port = tee_port + 1 + i
+        threading.Thread(target=client_tee.start, args=(host, client_tee_port, host, tee_port, host, verifier_port), kwargs={"session": True}, daemon=True).start()
+        client = Client(ca_cert_file, codec=args.codec)
+        client.set_personal_tee_public_key(client_tee.get_public_key())
+        sessions.append(ExtendedSession(client, client_tee, client_tee_port))
+
+    def stop():
+        tee_db_proxy.stop()
+        verifier.close()
+    return sessions, stop
+
+SETUPS = {"naive": setup_naive, "simple": setup_simple, "extended": setup_extended}
+
+# =============================================================================
+# Load generation
+# =============================================================================
+
+def failed(result):
+    # The clients report refused attestations and bad signatures as strings instead of raising
+    return isinstance(result, str) or (isinstance(result, dict) and "error" in result)
+
+class LoadGenerator:
+    def __init__(self, sessions, routes, duration, warmup=0.0, rate=None, attest_every_request=False):
+        self.sessions = sessions
+        self.routes = routes
+        self.duration = duration
+        self.warmup = warmup
+        self.rate = rate
+        self.attest_every_request = attest_every_request
+        self.schedule = queue.Queue()
+        self.lock = threading.Lock()
+        # (route, latency in seconds, failed) of the requests started after the warmup
+        self.samples = []
+        self.max_backlog = 0
+
+    def run(self):
+        self.started = time.perf_counter()
+        self.measured_from = self.started + self.warmup
+        self.ends = self.measured_from + self.duration
+        if self.rate:
+            workers = [threading.Thread(target=self.open_loop_worker, args=(session,)) for session in self.sessions]
+        else:
+            workers = [threading.Thread(target=self.closed_loop_worker, args=(session, i)) for i, session in enumerate(self.sessions)]
+        for worker in workers:
+            worker.start()
+        if self.rate:
+            self.schedule_requests()
+        for worker in workers:
+            worker.join()
+        return self.samples
+
+    def send(self, session, route, started):
+        if self.attest_every_request:
+            session.forget_attestations()
+        try:
+            is_failed = failed(session.query(route))
+        except Exception:
+            is_failed = True
+        finished = time.perf_counter()
+        if started >= self.measured_from:
+            with self.lock:
+                self.samples.append((route, finished - started, is_failed))
+
+    def closed_loop_worker(self, session, offset):
+        sent = offset
+        while time.perf_counter() < self.ends:
+            self.send(session, self.routes[sent % len(self.routes)], time.perf_counter())
+            sent += 1
+
+    def open_loop_worker(self, session):
+        while True:
+            scheduled = self.schedule.get()
+            if scheduled is None:
+                break
+            route, at = scheduled
+            self.send(session, route, at)
+
+    def schedule_requests(self):
+        interval = 1 / self.rate
+        scheduled = 0
+        while True:
+            at = self.started + scheduled * interval
+            if at >= self.ends:
+                break
+            delay = at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.schedule.put((self.routes[scheduled % len(self.routes)], at))
+            self.max_backlog = max(self.max_backlog, self.schedule.qsize())
+            scheduled += 1
+        for _ in self.sessions:
+            self.schedule.put(None)
+
+# =============================================================================
+# Report
+# =============================================================================
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def summarize(samples, routes, duration):
+    rows = []
+    for route in routes + ["all"]:
+        route_samples = [sample for sample in samples if route in ("all", sample[0])]
+        latencies = sorted(latency for _, latency, is_failed in route_samples if not is_failed)
+        row = {"route": route, "requests": len(route_samples), "errors": sum(1 for sample in route_samples if sample[2]), "qps": len(latencies) / duration}
+        for name, fraction in (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            row[name] = percentile(latencies, fraction) * 1000 if latencies else None
+        row["max_ms"] = latencies[-1] * 1000 if latencies else None
+        rows.append(row)
+    return rows
+
+def print_report(rows):
+    print(f"{'route':<18}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'qps':>10}")
+    for row in rows:
+        latencies = "".join(f"{row[name]:>10.2f}" if row[name] is not None else f"{'-':>10}" for name in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))
+        print(f"{row['route']:<18}{row['requests']:>10}{row['errors']:>8}{latencies}{row['qps']:>10.1f}")
+
+def write_csv(path, rows, args):
+    new_file = not os.path.exists(path)
+    with open(path, mode="a", newline="") as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(["Timestamp", "Flow", "Mode", "Concurrency", "Rate", "Route", "Requests", "Errors", "p50 ms", "p95 ms", "p99 ms", "max ms", "QPS"])
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for row in rows:
+            writer.writerow([timestamp, args.flow, "open" if args.rate else "closed", args.concurrency, args.rate, row["route"], row["requests"], row["errors"], row["p50_ms"], row["p95_ms"], row["p99_ms"], row["max_ms"], row["qps"]])
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load generator for the naive, simple and extended flows")
+    parser.add_argument("flow", choices=list(FLOW_DIRECTORIES))
+    parser.add_argument("--routes", nargs="+", help="routes sent in turn by every session, all the routes of the flow by default")
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions sending queries at the same time")
+    parser.add_argument("--rate", type=float, help="requests per second over all the sessions (open loop), closed loop without it")
+    parser.add_argument("--duration", type=float, default=30, help="seconds measured after the warmup")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of load that are not reported")
+    parser.add_argument("--attest-every-request", action="store_true", help="forget the attestations of the session before every query")
+    parser.add_argument("--protocol", choices=["sequential", "batched"], default="sequential", help="attestation protocol of the extended flow")
+    parser.add_argument("--codec", choices=["json", "bson"], default="json")
+    parser.add_argument("--async-verifier", action="store_true", help="runs the verifier of the extended flow on an event loop, see Verifier.serve_async")
+    parser.add_argument("--storage", choices=["mongo", "memory"], default="mongo", help="memory runs the simple and extended flows without MongoDB")
+    parser.add_argument("--scale", type=float, default=0.001, help="generated documents per collection of the memory storage, in millions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-port", type=int, default=12400, help="first of the ports used by the parties")
+    parser.add_argument("--csv", help="appends the report to this file")
+    args = parser.parse_args()
+
+    routes = args.routes or FLOW_ROUTES[args.flow]
+    unsupported = [route for route in routes if route not in FLOW_ROUTES[args.flow]]
+    if unsupported:
+        parser.error(f"the {args.flow} flow does not serve {', '.join(unsupported)}")
+    if args.flow == "naive" and args.storage == "memory":
+        parser.error("the naive flow only runs on MongoDB")
+    if args.async_verifier and args.flow != "extended":
+        parser.error("only the extended flow has an asyncio verifier")
+    sys.path.insert(0, FLOW_DIRECTORIES[args.flow])
+
+    sessions, stop = SETUPS[args.flow](args)
+    try:
+        generator = LoadGenerator(sessions, routes, args.duration, args.warmup, args.rate, args.attest_every_request)
+        samples = generator.run()
+    finally:
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
+        stop()
+    rows = summarize(samples, routes, args.duration)
+    mode = f"open loop at {args.rate:g} requests/s, backlog up to {generator.max_backlog}" if args.rate else "closed loop"
+    print(f"{args.flow} flow, {args.concurrency} sessions, {mode}, {args.duration:g}s measured after {args.warmup:g}s of warmup")
+    print_report(rows)
+    if args.csv:
+        write_csv(args.csv, rows, args)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import copy
 import time
 from wolfssl import SSLContext, PROTOCOL_TLSv1_3, CERT_REQUIRED
 import socket
@@ -11,6 +12,7 @@ class TLSHelper:
         self.context.load_verify_locations(ca_cert_file)
         self.is_server = is_server
         self.socket_ = None
+        self.server_socket = None
 
     def connect(self, host, port):
         max_tries = 30
@@ -32,6 +34,27 @@ class TLSHelper:
                 time.sleep(delay)
         raise ConnectionError("Failed to establish connection after multiple attempts")
 
+    def listen(self, host, port, backlog=128):
+        """Binds a listening socket so that any number of clients can be accepted."""
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(backlog)
+
+    def accept(self):
+        """Waits for the next client and returns its raw socket, the TLS handshake is left to wrap_accepted."""
+        if not self.server_socket:
+            raise ConnectionError("Helper is not listening")
+        conn, addr = self.server_socket.accept()
+        return conn
+
+    def wrap_accepted(self, conn):
+        """Performs the TLS handshake on an accepted socket and returns a helper dedicated to it."""
+        connection = copy.copy(self)
+        connection.server_socket = None
+        connection.socket_ = self.context.wrap_socket(conn, server_side=True)
+        return connection
+
     def send(self, message):
         if not self.socket_:
             raise ConnectionError("No active connection to send data")
@@ -47,9 +70,17 @@ class TLSHelper:
 
     def close(self):
         try:
+            if self.server_socket:
+                try:
+                    # Wakes up a thread blocked in accept()
+                    self.server_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.server_socket.close()
+                self.server_socket = None
             if self.socket_:
                 self.socket_.shutdown(socket.SHUT_RDWR)
                 self.socket_.close()
                 self.socket_ = None
-        except Exception as e:
+        except Exception:
             pass
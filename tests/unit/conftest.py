@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules shared by the simple and extended flows are identical, the tests import the extended ones.
+# tests/ holds populate_db.py, whose fixtures the storage tests query.
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+sys.path.insert(0, os.path.join(ROOT, "extended_data_access"))
@@ -0,0 +1,68 @@
+import json
+import pytest
+from audit_log import AuditLog
+
+def write_log(path, batches, per_batch=3):
+    log = AuditLog(path, flush_interval=60)
+    for batch in range(batches):
+        for index in range(per_batch):
+            log.record(route="get_bp", user="doctor1", batch=batch, index=index)
+        log.flush()
+    log.close()
+
+def test_chain_verifies(tmp_path):
+    path = str(tmp_path / "audit.log")
+    write_log(path, 3)
+    assert AuditLog.verify_chain(path) == 3
+
+def test_chain_goes_on_across_restarts(tmp_path):
+    path = str(tmp_path / "audit.log")
+    write_log(path, 2)
+    write_log(path, 2)
+    assert AuditLog.verify_chain(path) == 4
+
+def test_edited_record_breaks_the_chain(tmp_path):
+    path = str(tmp_path / "audit.log")
+    write_log(path, 2)
+    with open(path, "rb") as file:
+        lines = file.readlines()
+    record = json.loads(lines[0])
+    record["user"] = "external1"
+    lines[0] = json.dumps(record, separators=(",", ":")).encode() + b"\n"
+    with open(path, "wb") as file:
+        file.writelines(lines)
+    with pytest.raises(ValueError):
+        AuditLog.verify_chain(path)
+
+def test_removed_record_breaks_the_chain(tmp_path):
+    path = str(tmp_path / "audit.log")
+    write_log(path, 2)
+    with open(path, "rb") as file:
+        lines = file.readlines()
+    with open(path, "wb") as file:
+        file.writelines(lines[1:])
+    with pytest.raises(ValueError):
+        AuditLog.verify_chain(path)
+
+def test_torn_trailing_write_is_cut_on_restart(tmp_path):
+    path = str(tmp_path / "audit.log")
+    write_log(path, 2)
+    # A crash in the middle of a batch: one complete record and a partial one, without chain line
+    torn = b'{"route":"get_bp","t":1}\n{"route":"get_'
+    with open(path, "ab") as file:
+        file.write(torn)
+    with pytest.raises(ValueError):
+        AuditLog.verify_chain(path)
+    write_log(path, 1)
+    assert AuditLog.verify_chain(path) == 3
+    with open(path + ".torn", "rb") as file:
+        assert file.read() == torn
+    with open(path, "rb") as file:
+        assert torn not in file.read()
+
+def test_log_without_any_complete_batch_starts_a_new_chain(tmp_path):
+    path = str(tmp_path / "audit.log")
+    with open(path, "wb") as file:
+        file.write(b'{"route":"get_bp"')
+    write_log(path, 1)
+    assert AuditLog.verify_chain(path) == 1
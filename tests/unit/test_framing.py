@@ -0,0 +1,90 @@
+import os
+import socket
+import pytest
+
+pytest.importorskip("wolfssl")
+
+from TLS_helper import TLSHelper, FRAME_HEADER, FRAME_MESSAGE, FRAME_CHUNK, FRAME_END, FRAME_BSON
+from tools import BSON_CODEC, JSON_CODEC
+
+CERTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "extended_data_access", "certs")
+
+# The helpers exchange their frames over a socket pair, the framing does not depend on TLS
+
+def make_pair(**options):
+    sender = TLSHelper(os.path.join(CERTS, "ca-cert.pem"), **options)
+    receiver = TLSHelper(os.path.join(CERTS, "ca-cert.pem"), os.path.join(CERTS, "server-cert.pem"), os.path.join(CERTS, "server-key.pem"), is_server=True, **options)
+    sender.socket_, receiver.socket_ = socket.socketpair()
+    return sender, receiver
+
+@pytest.fixture
+def pair():
+    sender, receiver = make_pair()
+    yield sender, receiver
+    sender.close()
+    receiver.close()
+
+def test_small_message_is_a_single_frame(pair):
+    sender, receiver = pair
+    sender.send_message({"route": "get_bp", "params": {"patient_id": "1" * 24}})
+    frame_type, payload = receiver.receive_frame()
+    assert frame_type == FRAME_MESSAGE
+    assert b"get_bp" in payload
+
+def test_json_round_trip(pair):
+    sender, receiver = pair
+    sender.send_message({"route": "get_bp", "value": 1.5})
+    assert receiver.receive_message() == {"route": "get_bp", "value": 1.5}
+    assert receiver.codec == JSON_CODEC
+
+def test_bson_flag_sets_the_codec_of_the_receiver(pair):
+    sender, receiver = pair
+    sender.codec = BSON_CODEC
+    sender.send_message({"signature": b"\x00\xff" * 32})
+    frame_type, payload = receiver.receive_frame()
+    assert frame_type == FRAME_MESSAGE | FRAME_BSON
+    sender.send_message({"signature": b"\x00\xff" * 32})
+    assert receiver.receive_message() == {"signature": b"\x00\xff" * 32}
+    # A server answers with the codec chosen by its client
+    assert receiver.codec == BSON_CODEC
+
+def test_large_message_is_streamed_and_reassembled():
+    sender, receiver = make_pair(chunk_size=1024)
+    payload = os.urandom(10 * 1024 + 7)
+    sender.send(payload)
+    frame_types = []
+    while True:
+        frame_type, chunk = receiver.receive_frame()
+        frame_types.append(frame_type)
+        if frame_type == FRAME_END:
+            break
+    assert frame_types == [FRAME_CHUNK] * 11 + [FRAME_END]
+    sender.send(payload, FRAME_BSON)
+    flags, received = receiver.receive_payload()
+    assert flags == FRAME_BSON
+    assert bytes(received) == payload
+
+def test_oversize_frame_is_not_sent():
+    sender, receiver = make_pair(chunk_size=4096, max_frame_size=1024)
+    with pytest.raises(ValueError):
+        sender.send(b"x" * 2048)
+
+def test_oversize_announced_frame_is_rejected():
+    sender, receiver = make_pair(max_frame_size=1024)
+    sender.socket_.sendall(FRAME_HEADER.pack(FRAME_MESSAGE, 1025))
+    with pytest.raises(ConnectionError):
+        receiver.receive_payload()
+
+def test_oversize_stream_is_rejected():
+    sender, receiver = make_pair(chunk_size=1024, max_message_size=4096)
+    sender.send(b"x" * 4096)
+    assert len(receiver.receive_payload()[1]) == 4096
+    sender.send(b"x" * 4097)
+    with pytest.raises(ConnectionError):
+        receiver.receive_payload()
+
+def test_unexpected_frame_type_is_rejected(pair):
+    sender, receiver = pair
+    sender.send_frame(FRAME_END, b"")
+    with pytest.raises(ConnectionError):
+        receiver.receive_payload()
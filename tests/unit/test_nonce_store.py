@@ -0,0 +1,50 @@
+import nonce_store
+from nonce_store import NonceStore
+
+def test_nonce_is_consumed_once():
+    store = NonceStore()
+    store.add("nonce")
+    assert store.consume("nonce")
+    # A replayed evidence carries a nonce that was already consumed
+    assert not store.consume("nonce")
+    metrics = store.get_metrics()
+    assert metrics["consumed"] == 1
+    assert metrics["rejected"] == 1
+    assert metrics["pending"] == 0
+
+def test_unknown_nonce_is_rejected():
+    store = NonceStore()
+    store.add("nonce")
+    assert not store.consume("other")
+    assert store.consume("nonce")
+
+def test_expired_nonce_is_rejected(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(nonce_store.time, "monotonic", lambda: now[0])
+    store = NonceStore(lifetime=10)
+    store.add("old")
+    now[0] += 5
+    store.add("recent")
+    now[0] += 6
+    assert not store.consume("old")
+    assert store.consume("recent")
+    assert store.get_metrics()["expired"] == 1
+
+def test_expired_nonces_are_evicted_on_add(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(nonce_store.time, "monotonic", lambda: now[0])
+    store = NonceStore(lifetime=10)
+    for index in range(5):
+        store.add(index)
+    now[0] += 11
+    store.add("fresh")
+    assert len(store) == 1
+
+def test_capacity_evicts_the_oldest_nonce():
+    store = NonceStore(capacity=2)
+    for nonce in ("a", "b", "c"):
+        store.add(nonce)
+    assert not store.consume("a")
+    assert store.consume("b")
+    assert store.consume("c")
+    assert store.get_metrics()["evicted"] == 1
@@ -0,0 +1,45 @@
+import copy
+from pipeline_template import PipelineTemplate
+
+PIPELINE = [
+    {"$match": {"patientId": "$patient_id", "deleted": False}},
+    {"$lookup": {"from": "accessControls", "localField": "accessControl", "foreignField": "_id", "as": "controls"}},
+    {"$project": {"_id": 0, "bp": "$data.bp", "allowed": {"$in": ["$user_id", "$controls.users"]}}},
+]
+
+def test_render_without_parameters_returns_the_stored_pipeline():
+    template = PipelineTemplate(PIPELINE)
+    assert template.render({}) is template.pipeline
+
+def test_render_fills_the_slots_and_shares_the_rest():
+    stored = copy.deepcopy(PIPELINE)
+    template = PipelineTemplate(PIPELINE)
+    rendered = template.render({"patient_id": "p1", "user_id": "u1"})
+    assert rendered[0]["$match"] == {"patientId": "p1", "deleted": False}
+    assert rendered[2]["$project"]["allowed"] == {"$in": ["u1", "$controls.users"]}
+    # Field references that no parameter names are left alone
+    assert rendered[2]["$project"]["bp"] == "$data.bp"
+    # Only the containers leading to a filled slot are copied
+    assert rendered is not PIPELINE
+    assert rendered[1] is PIPELINE[1]
+    assert rendered[0] is not PIPELINE[0]
+    assert rendered[2]["$project"]["allowed"]["$in"] is not PIPELINE[2]["$project"]["allowed"]["$in"]
+    assert PIPELINE == stored
+
+def test_render_only_copies_the_slots_of_the_given_parameters():
+    template = PipelineTemplate(PIPELINE)
+    rendered = template.render({"patient_id": "p1"})
+    assert rendered[0]["$match"]["patientId"] == "p1"
+    assert rendered[2] is PIPELINE[2]
+
+def test_plans_are_reused_per_set_of_parameter_names():
+    template = PipelineTemplate(PIPELINE)
+    first = template.render({"patient_id": "p1", "user_id": "u1"})
+    second = template.render({"patient_id": "p2", "user_id": "u2"})
+    assert len(template.plans) == 1
+    assert first[0]["$match"]["patientId"] == "p1"
+    assert second[0]["$match"]["patientId"] == "p2"
+
+def test_digest_follows_the_pipeline():
+    assert PipelineTemplate(PIPELINE).digest == PipelineTemplate(copy.deepcopy(PIPELINE)).digest
+    assert PipelineTemplate(PIPELINE).digest != PipelineTemplate(PIPELINE[:2]).digest
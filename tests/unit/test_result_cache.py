@@ -0,0 +1,82 @@
+import result_cache
+from result_cache import ResultCache
+
+SIGNED = (b"result", b"signature")
+
+def test_hit_after_put():
+    cache = ResultCache()
+    key = cache.key("digest", {"patient_id": "p1"}, "patients")
+    assert cache.get(key) is None
+    cache.put(key, SIGNED)
+    assert cache.get(key) == SIGNED
+    metrics = cache.get_metrics()
+    assert (metrics["hits"], metrics["misses"]) == (1, 1)
+
+def test_invalidate_drops_only_the_tagged_results():
+    cache = ResultCache()
+    first = cache.key("digest", {"patient_id": "p1"}, "patients")
+    second = cache.key("digest", {"patient_id": "p2"}, "patients")
+    cache.put(first, SIGNED, tags=["ac1"])
+    cache.put(second, SIGNED, tags=["ac2"])
+    cache.invalidate("ac1")
+    assert cache.get(first) is None
+    assert cache.get(second) == SIGNED
+
+def test_write_to_the_collection_makes_its_results_unreachable():
+    cache = ResultCache()
+    key = cache.key("digest", {"patient_id": "p1"}, "patients")
+    other = cache.key("digest", {}, "bp")
+    cache.put(key, SIGNED)
+    cache.put(other, SIGNED)
+    cache.bump("patients")
+    assert cache.get(cache.key("digest", {"patient_id": "p1"}, "patients")) is None
+    assert cache.get(cache.key("digest", {}, "bp")) == SIGNED
+
+def test_result_computed_across_an_invalidation_is_not_stored():
+    cache = ResultCache()
+    key = cache.key("digest", {"patient_id": "p1"}, "patients")
+    generation = cache.generation
+    cache.invalidate("ac1")
+    cache.put(key, SIGNED, tags=["ac1"], generation=generation)
+    assert cache.get(key) is None
+
+def test_clear_drops_everything():
+    cache = ResultCache()
+    keys = [cache.key("digest", {"patient_id": index}, "patients") for index in range(3)]
+    for key in keys:
+        cache.put(key, SIGNED, tags=["ac1"])
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get_metrics()["size"] == 0
+    assert all(cache.get(key) is None for key in keys)
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache.time, "time", lambda: now[0])
+    cache = ResultCache(ttl=60)
+    key = cache.key("digest", {}, "bp")
+    short = cache.key("digest", {"patient_id": "p1"}, "patients")
+    cache.put(key, SIGNED)
+    cache.put(short, SIGNED, valid_until=now[0] + 10)
+    now[0] += 11
+    assert cache.get(short) is None
+    assert cache.get(key) == SIGNED
+    now[0] += 50
+    assert cache.get(key) is None
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(capacity=2)
+    keys = [cache.key("digest", {"patient_id": index}, "patients") for index in range(3)]
+    cache.put(keys[0], SIGNED)
+    cache.put(keys[1], SIGNED)
+    cache.get(keys[0])
+    cache.put(keys[2], SIGNED)
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == SIGNED
+    assert cache.get(keys[2]) == SIGNED
+
+def test_entries_larger_than_a_sixteenth_of_the_capacity_are_not_stored():
+    cache = ResultCache(capacity_bytes=1600)
+    key = cache.key("digest", {}, "bp")
+    cache.put(key, (b"x" * 100, b"signature"))
+    assert cache.get(key) is None
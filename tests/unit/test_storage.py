@@ -0,0 +1,71 @@
+import math
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+import populate_db
+from pipeline_template import PipelineTemplate
+from storage import MemoryStorage
+
+# The pipelines of populate_db.py over its fixtures and generated documents, on the in-memory storage and,
+# when one listens on localhost, on MongoDB. Both must give the results MongoDB gives.
+
+ENTRIES = 500
+SEED = 7
+PIPELINES = {pipeline["name"]: PipelineTemplate(pipeline["pipeline"]) for pipeline in populate_db.pipelines}
+
+# (user, attestation): output of get_bp and get_height for the fixture patient
+EXPECTED = {
+    (populate_db.doctor, True): ([{"bp": 100.0}], [{"height": None}]),
+    (populate_db.doctor, False): ([{"bp": 100.0}], [{"height": None}]),
+    (populate_db.patient, True): ([{"bp": 100.0}], [{"height": 170}]),
+    (populate_db.patient, False): ([{"bp": 100.0}], [{"height": 170}]),
+    (populate_db.external, True): ([{"bp": 100.0}], [{"height": None}]),
+    (populate_db.external, False): ([{"bp": "attestation required"}], [{"height": None}]),
+}
+
+@pytest.fixture(scope="module", params=["memory", "mongo"])
+def database(request):
+    if request.param == "memory":
+        yield MemoryStorage()["test_storage"]
+        return
+    client = MongoClient("localhost", 27017, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("MongoDB is not reachable on localhost")
+    yield client["test_storage"]
+    client.drop_database("test_storage")
+
+@pytest.fixture(scope="module")
+def populated(database):
+    populate_db.populate(database, ENTRIES, SEED)
+    return database
+
+@pytest.mark.parametrize("user, attestation", list(EXPECTED))
+def test_access_control_pipelines(populated, user, attestation):
+    params = {"patient_id": populate_db.patient, "user_id": user, "attestation": attestation}
+    expected_bp, expected_height = EXPECTED[(user, attestation)]
+    assert list(populated["patients"].aggregate(PIPELINES["get_bp"].render(params))) == expected_bp
+    assert list(populated["patients"].aggregate(PIPELINES["get_height"].render(params))) == expected_height
+
+def test_unknown_patient_gives_no_result(populated):
+    params = {"patient_id": populate_db.external, "user_id": populate_db.doctor, "attestation": True}
+    assert list(populated["patients"].aggregate(PIPELINES["get_bp"].render(params))) == []
+
+def test_is_bp_above_mean(populated):
+    values = [document["bp"] for document in populated["bps"].find({}, {"bp": 1})]
+    assert len(values) == ENTRIES
+    mean = math.fsum(values) / len(values)
+    for input_bp, expected in ((mean + 1, "1"), (mean - 1, "-1")):
+        result = list(populated["bps"].aggregate(PIPELINES["is_bp_above_mean"].render({"input_bp": input_bp})))
+        assert len(result) == 1
+        assert result[0]["mean_bp"] == pytest.approx(mean)
+        assert result[0]["is_above"] == expected
+
+def test_is_bp_above_mean_on_an_empty_collection(database):
+    assert list(database["empty"].aggregate(PIPELINES["is_bp_above_mean"].render({"input_bp": 120.0}))) == []
+
+def test_generated_documents_match_the_seed(populated):
+    rng = populate_db.random.Random(f"{SEED}:bps:0")
+    first = populate_db.generate_bp(0, rng)
+    assert populated["bps"].find_one({"_id": first["_id"]}) == first